@@ -0,0 +1,326 @@
+import argparse
+import glob
+import os
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from pipeline import DECODE_WORKERS, ENCODE_WORKERS, MAX_IN_FLIGHT_MB, run_pipeline
+from stats import RenderStats
+from watermark import DERIVATIVE_SIZES, EXPORT_DEFAULTS, Watermarker, WatermarkTemplate, decode_scaled, fit_size, \
+    get_common_root, get_output_path, get_save_options, watermark_region_file
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".ppm")
+MAX_CRASHES = 3
+
+_template = None
+
+
+def _init_worker(spec: dict, collect_stats: bool = False):
+    """Builds the watermark template once per worker process."""
+    global _template
+    _template = WatermarkTemplate.from_spec(spec, engine=Watermarker(stats=RenderStats() if collect_stats else None))
+
+
+def collect_inputs(inputs) -> list:
+    """Expands the given directories and globs into a sorted list of image paths."""
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            candidates = [os.path.join(entry, name) for name in os.listdir(entry)]
+        else:
+            candidates = glob.glob(entry, recursive=True)
+        for candidate in candidates:
+            if os.path.isfile(candidate) and candidate.lower().endswith(IMAGE_EXTENSIONS):
+                paths.add(os.path.abspath(candidate))
+    return sorted(paths)
+
+
+def get_input_root(inputs) -> str:
+    """Returns the deepest directory containing every input directory and the fixed part of every glob."""
+    roots = []
+    for entry in inputs:
+        root = entry
+        while glob.has_magic(root):
+            root = os.path.dirname(root)
+        if not os.path.isdir(root):
+            root = os.path.dirname(root)
+        roots.append(os.path.abspath(root or os.curdir))
+    return os.path.commonpath(roots)
+
+
+def watermark_file(path: str, output_path: str, spec: dict):
+    """Watermarks a single file according to the spec and writes it to the output path.
+
+    Returns the output path and, when the worker collects stats, the per-stage breakdown of this file.
+    """
+    template = _template if _template is not None else WatermarkTemplate.from_spec(spec)
+    engine = template.engine
+    if engine.stats is not None:
+        engine.stats.start_render()
+    os.makedirs(os.path.dirname(output_path) or os.curdir, exist_ok=True)
+    if spec.get("sizes"):
+        output_path = watermark_derivatives(path, output_path, spec, template)[0]
+        return output_path, engine.stats.last_render if engine.stats is not None else None
+    max_size = spec.get("max_size")
+    if not (spec.get("region") and max_size is None and watermark_region_file(path, output_path, template)):
+        image = engine.open_image(path, max_size=(max_size, max_size) if max_size else None)
+        result_img = template.apply(image, in_place=True)
+        engine.save_image(result_img, output_path, **get_save_options(output_path, result_img, spec.get("export")))
+    return output_path, engine.stats.last_render if engine.stats is not None else None
+
+
+def watermark_derivatives(path: str, output_path: str, spec: dict, template: WatermarkTemplate) -> list:
+    """Writes a watermarked copy of the file for every size in spec["sizes"] from a single decode.
+
+    The file is only decoded at the largest size needed. Returns the output paths, largest first.
+    """
+    engine = template.engine
+    sizes = spec["sizes"]
+    with engine._decode_stage(path):
+        image = Image.open(path)
+        reference_width = image.width
+        largest = None if None in sizes else max(sizes)
+        image = decode_scaled(image, fit_size(image.size, (largest, largest)) if largest else image.size)
+    output_paths = []
+    for max_size, result_img in template.apply_derivatives(image, sizes, reference_width):
+        derivative_path = get_derivative_path(output_path, max_size)
+        engine.save_image(result_img, derivative_path,
+                          **get_save_options(derivative_path, result_img, spec.get("export")))
+        output_paths.append(derivative_path)
+    return output_paths
+
+
+def get_derivative_path(output_path: str, max_size) -> str:
+    """Returns where the derivative of the given max size goes, e.g. photo_1024.jpg next to photo.jpg."""
+    if max_size is None:
+        return output_path
+    stem, extension = os.path.splitext(output_path)
+    return f"{stem}_{max_size}{extension}"
+
+
+def parse_size(value: str):
+    """Parses a --sizes entry, where "full" stands for the original size."""
+    return None if value == "full" else int(value)
+
+
+def run_batch(paths, output_dir: str, spec: dict, workers=None, stats: RenderStats = None,
+              input_root: str = None) -> dict:
+    """Watermarks every path on a process pool. Returns a dict of failed paths and their errors.
+
+    Outputs keep their path relative to input_root, which defaults to the deepest directory containing every
+    path. When stats are given, the per-stage timings of every file are aggregated into them.
+
+    At most two files per worker are in flight. When a worker process dies, the pool is rebuilt and the files
+    that were in flight are retried one at a time before the rest of the batch continues; a file is only
+    reported as failed once it crashed the pool MAX_CRASHES times on its own.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    input_root = input_root or (get_common_root(paths) if paths else os.curdir)
+    workers = workers or os.cpu_count() or 1
+    failures = {}
+    queued = deque(paths)
+    suspects = deque()
+    crashes = {}
+    in_flight = {}
+
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec, stats is not None))
+
+    def submit(source: deque):
+        path = source.popleft()
+        try:
+            future = pool.submit(watermark_file, path, get_output_path(path, input_root, output_dir), spec)
+        except BrokenProcessPool:
+            source.appendleft(path)
+            raise
+        in_flight[future] = path
+
+    pool = start_pool()
+    try:
+        while queued or suspects or in_flight:
+            try:
+                if suspects:
+                    if not in_flight:
+                        submit(suspects)
+                else:
+                    while queued and len(in_flight) < 2 * workers:
+                        submit(queued)
+            except BrokenProcessPool:
+                if not in_flight:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = start_pool()
+                    continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    output_path, render = future.result()
+                except BrokenProcessPool as error:
+                    broken = True
+                    if path not in crashes:
+                        crashes[path] = 0
+                        suspects.append(path)
+                    elif crashes[path] + 1 < MAX_CRASHES:
+                        crashes[path] += 1
+                        suspects.append(path)
+                    else:
+                        failures[path] = error
+                        report(path, None, error)
+                except Exception as error:
+                    failures[path] = error
+                    report(path, None, error)
+                else:
+                    if stats is not None:
+                        stats.add_render(render)
+                    report(path, output_path, None)
+            if broken:
+                for path in in_flight.values():
+                    crashes.setdefault(path, 0)
+                    suspects.append(path)
+                in_flight.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = start_pool()
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return failures
+
+
+def check_spec(parser: argparse.ArgumentParser, spec: dict):
+    """Builds the watermark once up front, so a missing logo or font fails before any worker starts."""
+    try:
+        template = WatermarkTemplate.from_spec(spec)
+        if template.operation == "text":
+            template.get_layer(0)
+    except (OSError, ValueError) as error:
+        parser.error(f"cannot build the watermark: {error}")
+
+
+def report(path: str, output_path, error):
+    """Prints the outcome of one file."""
+    if error is not None:
+        print(f"FAILED {path}: {error!r}", file=sys.stderr)
+    else:
+        print(f"{path} -> {output_path}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Builds the command line interface of the batch watermarker."""
+    parser = argparse.ArgumentParser(description="Watermark many images without the GUI.")
+    add_file_arguments(parser)
+    add_batch_arguments(parser)
+    return parser
+
+
+def add_file_arguments(parser: argparse.ArgumentParser):
+    """Adds the inputs, the output directory, the watermark spec and the options of watermark_file."""
+    parser.add_argument("inputs", nargs="+", help="input directories or glob patterns")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    add_spec_arguments(parser)
+    parser.add_argument("--region", action="store_true",
+                        help="for uncompressed TIFF, BMP and PPM files only decode the rows under the watermark; "
+                             "the output keeps the source's format, encoding and metadata byte for byte, so the "
+                             "encoder and metadata options cannot be combined with it")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=None, metavar="SIZE",
+                        help="write one watermarked copy per longest-side size from a single decode, e.g. "
+                             f"{' '.join('full' if size is None else str(size) for size in DERIVATIVE_SIZES)}")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (defaults to the number of cores)")
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    """Adds the options only a one-off batch run honours: stats and the streaming pipeline."""
+    parser.add_argument("--stats", help="write per-stage timings aggregated over the batch as JSON to this file")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap decoding, compositing and encoding in a threaded streaming pipeline; "
+                             "-j then sets the number of compositing threads")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS, help="decoding threads with --pipeline")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS, help="encoding threads with --pipeline")
+    parser.add_argument("--max-in-flight-mb", type=int, default=MAX_IN_FLIGHT_MB,
+                        help="memory cap for decoded images in flight with --pipeline")
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser):
+    """Adds the options that make up a watermark spec, see spec_from_args."""
+    watermark = parser.add_mutually_exclusive_group(required=True)
+    watermark.add_argument("--text", help="text watermark")
+    watermark.add_argument("--watermark-image", help="path of the image watermark")
+    parser.add_argument("--position", default="bottom-right",
+                        choices=["top-left", "top-right", "bottom-left", "bottom-right"])
+    parser.add_argument("--margin-x", type=int, default=15)
+    parser.add_argument("--margin-y", type=int, default=15)
+    parser.add_argument("--font-size", type=int, default=30)
+    parser.add_argument("--colour", default="#FF6B6B")
+    parser.add_argument("--size", default="large", choices=["large", "medium", "small"])
+    parser.add_argument("--opacity", type=float, default=1.0, help="watermark opacity between 0 and 1")
+    parser.add_argument("--tiled", action="store_true", help="repeat the watermark diagonally over the whole image")
+    parser.add_argument("--angle", type=float, default=30, help="rotation of the tiled watermark in degrees")
+    parser.add_argument("--max-size", type=int, default=None,
+                        help="shrink the output to fit into a square of this many pixels before watermarking")
+    parser.add_argument("--quality", type=int, default=EXPORT_DEFAULTS["quality"], help="JPEG quality")
+    parser.add_argument("--subsampling", default=EXPORT_DEFAULTS["subsampling"], choices=["4:4:4", "4:2:2", "4:2:0"],
+                        help="JPEG chroma subsampling")
+    parser.add_argument("--progressive", action="store_true", help="write progressive JPEGs")
+    parser.add_argument("--compress-level", type=int, default=EXPORT_DEFAULTS["compress_level"],
+                        choices=range(10), metavar="{0-9}", help="PNG compression level")
+    parser.add_argument("--optimize", action="store_true", help="let the encoder optimize for file size")
+    parser.add_argument("--strip-metadata", action="store_true", help="do not copy EXIF data and ICC profiles")
+
+
+def spec_from_args(args) -> dict:
+    """Turns the parsed command line arguments into a watermark spec."""
+    spec = {"position": args.position, "margin_x": args.margin_x, "margin_y": args.margin_y,
+            "opacity": args.opacity, "tiled": args.tiled, "angle": args.angle,
+            "max_size": args.max_size, "region": getattr(args, "region", False),
+            "sizes": getattr(args, "sizes", None),
+            "export": {"quality": args.quality, "subsampling": args.subsampling, "progressive": args.progressive,
+                       "compress_level": args.compress_level, "optimize": args.optimize,
+                       "keep_metadata": not args.strip_metadata}}
+    if args.text is not None:
+        spec.update(operation="text", text=args.text, font_size=args.font_size, colour=args.colour)
+    else:
+        spec.update(operation="image", watermark_path=args.watermark_image, image_size=args.size)
+    return spec
+
+
+def check_file_arguments(parser: argparse.ArgumentParser, args):
+    """Rejects combinations of the add_file_arguments options that would be silently ignored."""
+    if args.sizes and args.max_size:
+        parser.error("--sizes cannot be combined with --max-size")
+    if args.region and spec_from_args(args)["export"] != EXPORT_DEFAULTS:
+        parser.error("--region keeps the source encoding and metadata and cannot be combined with encoder or "
+                     "metadata options")
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.sizes and args.pipeline:
+        parser.error("--sizes cannot be combined with --pipeline")
+    check_file_arguments(parser, args)
+    check_spec(parser, spec_from_args(args))
+    paths = collect_inputs(args.inputs)
+    if not paths:
+        print("No input images found.", file=sys.stderr)
+        return 1
+    stats = RenderStats() if args.stats else None
+    if args.pipeline:
+        failures = run_pipeline(paths, args.output, spec_from_args(args), decode_workers=args.decode_workers,
+                                composite_workers=args.workers, encode_workers=args.encode_workers,
+                                max_in_flight_mb=args.max_in_flight_mb, stats=stats, report=report,
+                                input_root=get_input_root(args.inputs))
+    else:
+        failures = run_batch(paths, args.output, spec_from_args(args), workers=args.workers, stats=stats,
+                             input_root=get_input_root(args.inputs))
+    if stats is not None:
+        stats.to_json(args.stats)
+    print(f"Watermarked {len(paths) - len(failures)} of {len(paths)} images, {len(failures)} failed.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
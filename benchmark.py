@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from PIL import Image, ImageDraw, ImageFont
+
+import watermark
+from stats import percentile
+from watermark import Watermarker
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_MEGAPIXELS = [1, 4, 12, 24]
+MODES = ["RGB", "RGBA"]
+FORMATS = ["JPEG", "PNG"]
+OPERATIONS = ["place_text_watermark", "place_image_watermark", "_resize_watermark",
+              "watermark_preview_cold", "watermark_preview_warm"]
+TEXT_OPERATIONS = ["place_text_watermark", "watermark_preview_cold", "watermark_preview_warm"]
+REGRESSION_THRESHOLD = 0.10
+REGRESSION_FLOOR_MS = 1.0
+MIN_REGRESSION_RUNS = 5
+WARMUP = 2
+
+
+class _PreviewController:
+    """Stands in for the GUI, which watermark_preview reports the preview size to."""
+    preview_width = None
+    preview_height = None
+
+
+def make_base_image(megapixels: float, mode: str) -> Image:
+    """Generates a 3:2 synthetic photo-like image of roughly the requested size."""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    gradient = Image.linear_gradient("L")
+    bands = [gradient.resize((width, height)),
+             gradient.rotate(90).resize((width, height)),
+             Image.effect_noise((width, height), 40)]
+    if mode == "RGBA":
+        bands.append(gradient.rotate(180).resize((width, height)))
+    return Image.merge(mode, bands)
+
+
+def make_logo(size=(600, 300)) -> Image:
+    """Generates a synthetic RGBA logo with transparent surroundings."""
+    logo = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse((0, 0, size[1], size[1]), fill=(255, 107, 107, 255))
+    draw.rectangle((size[1], size[1] // 4, size[0], size[1] * 3 // 4), fill=(65, 174, 169, 200))
+    return logo
+
+
+def prepare_inputs(directory: str, megapixels, modes, formats) -> list:
+    """Writes every base image variant and the logo into the directory. Returns the benchmark cases."""
+    cases = []
+    for mp in megapixels:
+        for mode in modes:
+            image = None
+            for image_format in formats:
+                if image_format == "JPEG" and mode == "RGBA":
+                    continue
+                path = os.path.join(directory, f"base_{mp}mp_{mode}.{image_format.lower()}")
+                if not os.path.exists(path):
+                    image = image if image is not None else make_base_image(mp, mode)
+                    image.save(path, image_format)
+                cases.append({"name": f"{mp}MP {mode} {image_format}", "path": path})
+    logo_path = os.path.join(directory, "logo.png")
+    if not os.path.exists(logo_path):
+        make_logo().save(logo_path)
+    for case in cases:
+        case["logo_path"] = logo_path
+    return cases
+
+
+def _time_calls(setup, call, repeat: int, warmup: int = WARMUP) -> list:
+    """Times call(setup()) repeat times, excluding the setup, and returns the durations in seconds.
+
+    The first warmup calls are not timed, so caches and lazy imports do not count against the first run.
+    """
+    for _ in range(warmup):
+        call(setup())
+    durations = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        call(argument)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _peak_memory_mb():
+    """Returns the peak resident memory of the current process in MB, if the platform can tell."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(case: dict, operation: str, repeat: int, font_path: str, warmup: int = WARMUP) -> dict:
+    """Benchmarks one operation on one input. Runs in a fresh process so the peak memory belongs to the case."""
+    watermark.FONT_PATH = font_path
+    engine = Watermarker()
+    base_img = Image.open(case["path"])
+    base_img.load()
+    logo = Image.open(case["logo_path"])
+    logo.load()
+    controller = _PreviewController()
+    preview_kwargs = dict(controller=controller, operation="text", path=case["path"], position="bottom-right",
+                          margin_x=15, margin_y=15, in_memory=True, font_size=60, text="EZ Mark",
+                          colour="#FF6B6B")
+
+    if operation == "place_text_watermark":
+        durations = _time_calls(base_img.copy, lambda image: engine.place_text_watermark(
+            image=image, font_size=60, position="bottom-right", margin_x=15, margin_y=15, colour="#FF6B6B",
+            text="EZ Mark"), repeat, warmup)
+    elif operation == "place_image_watermark":
+        durations = _time_calls(lambda: base_img, lambda image: engine.place_image_watermark(
+            image, logo, size="large", position="bottom-right", margin_x=15, margin_y=15), repeat, warmup)
+    elif operation == "_resize_watermark":
+        durations = _time_calls(lambda: base_img.width, lambda width: engine._resize_watermark(
+            width, logo, size="large"), repeat, warmup)
+    elif operation == "watermark_preview_cold":
+        durations = _time_calls(engine.clear_preview_cache,
+                                lambda _: engine.watermark_preview(**preview_kwargs), repeat, warmup)
+    elif operation == "watermark_preview_warm":
+        engine.watermark_preview(**preview_kwargs)
+        durations = _time_calls(lambda: None, lambda _: engine.watermark_preview(**preview_kwargs), repeat, warmup)
+    else:
+        raise ValueError
+    return summarize(case["name"], operation, durations, base_img.width * base_img.height, _peak_memory_mb())
+
+
+def summarize(name: str, operation: str, durations, pixels: int, peak_memory_mb) -> dict:
+    """Reduces raw durations to latency percentiles and throughput."""
+    durations = sorted(durations)
+    mean = sum(durations) / len(durations)
+    return {
+        "case": name,
+        "operation": operation,
+        "runs": len(durations),
+        "p50_ms": percentile(durations, 0.50) * 1000,
+        "p90_ms": percentile(durations, 0.90) * 1000,
+        "p99_ms": percentile(durations, 0.99) * 1000,
+        "images_per_s": 1 / mean if mean else float("inf"),
+        "megapixels_per_s": pixels / 1_000_000 / mean if mean else float("inf"),
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+
+def compare_to_baseline(results, baseline, threshold: float = REGRESSION_THRESHOLD,
+                        floor_ms: float = REGRESSION_FLOOR_MS) -> list:
+    """Returns the results whose median latency got worse than the baseline by more than the threshold.
+
+    Slowdowns of less than floor_ms, medians still within the baseline's p90 and cases with fewer than
+    MIN_REGRESSION_RUNS runs on either side are ignored, so run-to-run noise is not reported.
+    """
+    baseline_entries = {(entry["case"], entry["operation"]): entry for entry in baseline}
+    regressions = []
+    for result in results:
+        entry = baseline_entries.get((result["case"], result["operation"]))
+        if entry is None or min(entry["runs"], result["runs"]) < MIN_REGRESSION_RUNS:
+            continue
+        previous = entry["p50_ms"]
+        if result["p50_ms"] > previous * (1 + threshold) and result["p50_ms"] - previous > floor_ms \
+                and result["p50_ms"] > entry["p90_ms"]:
+            regressions.append(dict(result, baseline_p50_ms=previous))
+    return regressions
+
+
+def print_report(results, regressions):
+    """Prints the results as a table, marking regressions."""
+    regressed = {(entry["case"], entry["operation"]) for entry in regressions}
+    print(f"{'case':<18} {'operation':<24} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+          f"{'img/s':>8} {'MP/s':>8} {'peak MB':>8}")
+    for result in results:
+        peak = result["peak_memory_mb"]
+        flag = "  REGRESSION" if (result["case"], result["operation"]) in regressed else ""
+        print(f"{result['case']:<18} {result['operation']:<24} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['images_per_s']:>8.2f} {result['megapixels_per_s']:>8.1f} "
+              f"{'-' if peak is None else round(peak):>8}{flag}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Builds the command line interface of the benchmark suite."""
+    parser = argparse.ArgumentParser(description="Benchmark the Watermarker engine on synthetic images.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=DEFAULT_MEGAPIXELS,
+                        help="base image sizes to generate, e.g. 1 4 12 24 50 100")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--formats", nargs="+", default=FORMATS, choices=FORMATS)
+    parser.add_argument("--operations", nargs="+", default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=WARMUP, help="untimed runs before the timed ones")
+    parser.add_argument("--font", default=watermark.FONT_PATH, help="TrueType font for the text watermark")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "ezmark-benchmark"),
+                        help="where the synthetic images are generated and kept between runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results previously written with --output")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative slowdown of the median latency that counts as a regression")
+    parser.add_argument("--floor-ms", type=float, default=REGRESSION_FLOOR_MS,
+                        help="smallest absolute slowdown of the median latency that counts as a regression")
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if set(args.operations) & set(TEXT_OPERATIONS):
+        try:
+            ImageFont.truetype(args.font, 10)
+        except OSError:
+            parser.error(f"cannot open the font {args.font!r}; point --font at a TrueType font")
+    os.makedirs(args.data_dir, exist_ok=True)
+    cases = prepare_inputs(args.data_dir, args.megapixels, args.modes, args.formats)
+    results = []
+    for case in cases:
+        for operation in args.operations:
+            with Pool(1) as pool:
+                results.append(pool.apply(run_case, (case, operation, args.repeat, args.font, args.warmup)))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file), args.threshold, args.floor_ms)
+    print_report(results, regressions)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}.", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
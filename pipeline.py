@@ -0,0 +1,163 @@
+import os
+from queue import Queue
+from threading import Condition, Lock, Thread
+
+from PIL import Image
+
+from stats import RenderStats
+from watermark import Watermarker, WatermarkTemplate, decode_scaled, fit_size, get_common_root, get_output_path, \
+    get_save_options, watermark_region_file
+
+DECODE_WORKERS = 2
+ENCODE_WORKERS = 2
+MAX_IN_FLIGHT_MB = 1024
+QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class MemoryBudget:
+    """Bounds the memory held by decoded images that are in flight between the pipeline stages.
+
+    A single image larger than the whole budget is still let through once nothing else is in flight.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._condition = Condition()
+
+    def acquire(self, amount: int):
+        """Blocks until the amount fits into the budget, then takes it."""
+        with self._condition:
+            while self.used and self.used + amount > self.limit:
+                self._condition.wait()
+            self.used += amount
+
+    def release(self, amount: int):
+        """Gives the amount back to the budget."""
+        with self._condition:
+            self.used -= amount
+            self._condition.notify_all()
+
+
+def _decoded_size(image: Image, size) -> int:
+    """Estimates the bytes an opened image takes once decoded at the given size."""
+    return size[0] * size[1] * len(image.getbands())
+
+
+def run_pipeline(paths, output_dir: str, spec: dict, decode_workers: int = DECODE_WORKERS,
+                 composite_workers: int = None, encode_workers: int = ENCODE_WORKERS,
+                 max_in_flight_mb: int = MAX_IN_FLIGHT_MB, queue_size: int = QUEUE_SIZE,
+                 stats: RenderStats = None, report=None, input_root: str = None) -> dict:
+    """Watermarks every path in a streaming decode -> composite -> encode pipeline.
+
+    Each stage has its own threads and the stages are joined by bounded queues, so disk reads, compositing and
+    encoding overlap. Pillow does the heavy lifting of every stage in C without holding the GIL. Decoders wait
+    while the decoded images in flight would exceed max_in_flight_mb, keeping memory flat for any batch size.
+    Outputs keep their path relative to input_root like with run_batch. report is called with (path, output_path,
+    error) as files finish. Returns a dict of failed paths and their errors.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    input_root = input_root or (get_common_root(paths) if paths else os.curdir)
+    composite_workers = composite_workers or os.cpu_count() or 1
+    template = WatermarkTemplate.from_spec(spec, engine=Watermarker(stats=stats))
+    engine = template.engine
+    budget = MemoryBudget(max_in_flight_mb * 1024 * 1024)
+    max_size = spec.get("max_size")
+    failures = {}
+    failures_lock = Lock()
+
+    def finish(path, output_path=None, error=None):
+        if error is not None:
+            with failures_lock:
+                failures[path] = error
+        if report is not None:
+            report(path, output_path, error)
+
+    def decode(path):
+        output_path = get_output_path(path, input_root, output_dir)
+        reserved = 0
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            if engine.stats is not None:
+                engine.stats.start_render()
+            if spec.get("region") and max_size is None and watermark_region_file(path, output_path, template):
+                finish(path, output_path)
+                return None
+            image = Image.open(path)
+            size = fit_size(image.size, (max_size, max_size)) if max_size else image.size
+            reserved = _decoded_size(image, size)
+            budget.acquire(reserved)
+            with engine._decode_stage(path):
+                image = decode_scaled(image, size)
+            return path, output_path, image, reserved
+        except Exception as error:
+            budget.release(reserved)
+            finish(path, error=error)
+            return None
+
+    def composite(item):
+        path, output_path, image, reserved = item
+        try:
+            return path, output_path, template.apply(image, in_place=True), reserved
+        except Exception as error:
+            budget.release(reserved)
+            finish(path, error=error)
+            return None
+
+    def encode(item):
+        path, output_path, image, reserved = item
+        try:
+            engine.save_image(image, output_path, **get_save_options(output_path, image, spec.get("export")))
+        except Exception as error:
+            finish(path, error=error)
+        else:
+            finish(path, output_path)
+        finally:
+            budget.release(reserved)
+        return None
+
+    inbox = Queue()
+    for path in paths:
+        inbox.put(path)
+    decoded = Queue(maxsize=queue_size)
+    composited = Queue(maxsize=queue_size)
+    stages = [(decode, inbox, decoded, decode_workers),
+              (composite, decoded, composited, composite_workers),
+              (encode, composited, None, encode_workers)]
+    for _ in range(decode_workers):
+        inbox.put(_DONE)
+    threads = []
+    for index, (work, source, target, workers) in enumerate(stages):
+        downstream_workers = stages[index + 1][3] if target is not None else 0
+        remaining = [workers]
+        remaining_lock = Lock()
+        for _ in range(workers):
+            thread = Thread(target=_stage_worker, args=(work, source, target, downstream_workers,
+                                                        remaining, remaining_lock), daemon=True)
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return failures
+
+
+def _stage_worker(work, source: Queue, target, downstream_workers: int, remaining, remaining_lock):
+    """Feeds items from the source queue through work into the target queue until the source is done.
+
+    The last worker of a stage to finish tells every worker of the next stage that no more items will come.
+    """
+    while True:
+        item = source.get()
+        if item is _DONE:
+            break
+        result = work(item)
+        if result is not None and target is not None:
+            target.put(result)
+    with remaining_lock:
+        remaining[0] -= 1
+        last = remaining[0] == 0
+    if last and target is not None:
+        for _ in range(downstream_workers):
+            target.put(_DONE)
@@ -0,0 +1,282 @@
+import argparse
+import base64
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import BoundedSemaphore, Lock
+
+from PIL import Image
+
+from batch import add_spec_arguments, spec_from_args
+from watermark import WatermarkTemplate, decode_scaled, fit_size, get_save_options
+
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_PENDING = 32
+MAX_BODY_BYTES = 256 * 1024 * 1024
+WORKER_TEMPLATE_CACHE_SIZE = 16
+RETRY_AFTER_SECONDS = 1
+SPEC_OVERRIDES = ("position", "margin_x", "margin_y", "text", "font_size", "colour", "image_size", "opacity", "tiled",
+                  "angle", "spacing", "max_size", "format", "export")
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "TIFF": "image/tiff", "BMP": "image/bmp",
+                 "WEBP": "image/webp"}
+
+_default_spec = None
+_templates = OrderedDict()
+
+
+def _init_service_worker(default_spec: dict):
+    """Warms a worker process up by building the default template, which loads its font or logo."""
+    global _default_spec
+    _default_spec = default_spec
+    template = _get_template(default_spec)
+    if template.operation == "text":
+        template.get_layer(0)
+
+
+def _warm_up() -> bool:
+    """Does nothing; submitting it makes the pool start a worker process ahead of the first request."""
+    return True
+
+
+def _get_template(spec: dict) -> WatermarkTemplate:
+    """Returns the worker's template for the spec, building it on first use and evicting the least recently used."""
+    key = json.dumps(spec, sort_keys=True)
+    template = _templates.get(key)
+    if template is None:
+        template = WatermarkTemplate.from_spec(spec)
+        _templates[key] = template
+        while len(_templates) > WORKER_TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    else:
+        _templates.move_to_end(key)
+    return template
+
+
+def watermark_bytes(data: bytes, spec_overrides: dict = None):
+    """Watermarks encoded image bytes in a worker process. Returns the encoded result and its format.
+
+    spec_overrides are merged over the server's default spec and may only hold SPEC_OVERRIDES, so the operation
+    and the logo stay as configured on the server. The output keeps the input's format unless the spec asks for
+    another one with "format".
+    """
+    spec = dict(_default_spec, **(spec_overrides or {}))
+    image = Image.open(BytesIO(data))
+    image_format = spec.get("format") or image.format
+    max_size = spec.get("max_size")
+    image = decode_scaled(image, fit_size(image.size, (max_size, max_size)) if max_size else image.size)
+    template = _get_template(spec)
+    result_img = template.apply(image, in_place=True)
+    output = BytesIO()
+    template.engine.save_image(result_img, output, **get_save_options(None, result_img, spec.get("export"),
+                                                                      image_format=image_format))
+    return output.getvalue(), image_format
+
+
+class WatermarkServer(ThreadingHTTPServer):
+    """HTTP server that hands watermarking to a warm pool of worker processes.
+
+    At most max_pending images are accepted at once, counting every image of a batch; further requests are
+    turned away with 503 and a Retry-After header instead of queueing without bound. A batch larger than
+    max_pending could never fit and gets 413. When a worker dies, the pool is rebuilt and the requests it was
+    serving get 503; the server only reports itself broken while rebuilding fails.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, default_spec: dict, workers: int = None, max_pending: int = MAX_PENDING):
+        super().__init__(address, WatermarkRequestHandler)
+        self.default_spec = default_spec
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.pool_lock = Lock()
+        try:
+            self.pool = self._start_pool()
+        except BaseException:
+            self.server_close()
+            raise
+        self.broken = False
+        self.max_pending = max_pending
+        self.slots = BoundedSemaphore(max_pending)
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        """Starts a pool of worker processes and waits until every worker is warm, raising if one fails."""
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_service_worker,
+                                   initargs=(self.default_spec,))
+        try:
+            for future in [pool.submit(_warm_up) for _ in range(self.workers)]:
+                future.result()
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
+        return pool
+
+    def rebuild_pool(self, broken_pool: ProcessPoolExecutor) -> bool:
+        """Replaces the pool after a worker died, unless another request already did. Returns whether it works."""
+        with self.pool_lock:
+            if self.pool is broken_pool:
+                broken_pool.shutdown(wait=False, cancel_futures=True)
+                try:
+                    self.pool = self._start_pool()
+                except Exception:
+                    self.broken = True
+                else:
+                    self.broken = False
+            return not self.broken
+
+    def acquire_slots(self, count: int) -> bool:
+        """Takes count slots without blocking, or none at all if not enough are free."""
+        for taken in range(count):
+            if not self.slots.acquire(blocking=False):
+                self.release_slots(taken)
+                return False
+        return True
+
+    def release_slots(self, count: int):
+        for _ in range(count):
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    """Serves POST /watermark with raw image bytes, POST /batch with JSON, and GET /health.
+
+    /watermark reads an optional JSON spec from the X-Watermark-Spec header and answers with the watermarked
+    image. /batch takes {"spec": {...}, "images": [base64, ...]} and answers with {"images": [{"data": base64,
+    "format": name} or {"error": message}, ...]} in the same order.
+    """
+
+    server: WatermarkServer
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        if self.server.broken:
+            self._send_json(500, {"status": "broken", "max_pending": self.server.max_pending})
+            return
+        self._send_json(200, {"status": "ok", "max_pending": self.server.max_pending})
+
+    def do_POST(self):
+        if self.path not in ("/watermark", "/batch"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+        try:
+            if self.path == "/watermark":
+                spec = json.loads(self.headers.get("X-Watermark-Spec") or "{}")
+                images = [body]
+            else:
+                request = json.loads(body)
+                spec = request.get("spec") or {}
+                images = [base64.b64decode(image) for image in request["images"]]
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, "Malformed request")
+            return
+        if not isinstance(spec, dict) or not set(spec) <= set(SPEC_OVERRIDES):
+            self.send_error(400, f"Only {', '.join(SPEC_OVERRIDES)} can be overridden")
+            return
+        if len(images) > self.server.max_pending:
+            self.send_error(413, f"At most {self.server.max_pending} images per batch")
+            return
+        if not self.server.acquire_slots(len(images)):
+            self._send_unavailable()
+            return
+        pool = self.server.pool
+        try:
+            futures = [pool.submit(watermark_bytes, image, spec) for image in images]
+            if self.path == "/watermark":
+                self._send_image(futures[0])
+            else:
+                self._send_batch(futures)
+        except BrokenProcessPool:
+            if self.server.rebuild_pool(pool):
+                self._send_unavailable()
+            else:
+                self.send_error(500, "Worker pool is broken")
+        finally:
+            self.server.release_slots(len(images))
+
+    def _send_unavailable(self):
+        self.send_response(503)
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_image(self, future):
+        try:
+            data, image_format = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as error:
+            self.send_error(422, repr(error))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES.get(image_format, "application/octet-stream"))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_batch(self, futures):
+        results = []
+        for future in futures:
+            try:
+                data, image_format = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as error:
+                results.append({"error": repr(error)})
+            else:
+                results.append({"data": base64.b64encode(data).decode("ascii"), "format": image_format})
+        self._send_json(200, {"images": results})
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Builds the command line interface of the watermarking service."""
+    parser = argparse.ArgumentParser(description="Serve watermarking over HTTP on localhost.")
+    add_spec_arguments(parser)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of warm worker processes (defaults to the number of cores)")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING,
+                        help="images accepted at once before new requests get 503")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    server = WatermarkServer((HOST, args.port), spec_from_args(args), workers=args.workers,
+                             max_pending=args.max_pending)
+    print(f"Serving on http://{HOST}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import json
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from threading import Lock, local
+from time import perf_counter
+
+STAGES = ("decode", "font_load", "text_measure", "text_render", "resize", "composite", "encode")
+STATS_WINDOW = 10000
+
+NULL_STAGE = nullcontext()
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Returns the linearly interpolated percentile of an already sorted list."""
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class RenderStats:
+    """Collects how long each stage of the watermarking hot path takes and how many bytes it handles.
+
+    Durations are aggregated per stage over every render, and the stages of the render started last with
+    start_render are kept separately for each thread, so renders on different threads do not mix. The optional
+    callback is called with (stage, seconds, byte_count) on every recorded stage. Percentiles are taken over the
+    last STATS_WINDOW samples of each stage.
+    """
+
+    def __init__(self, callback=None, window: int = STATS_WINDOW):
+        self.callback = callback
+        self.window = window
+        self.renders = 0
+        self._counts = {}
+        self._totals = {}
+        self._bytes = {}
+        self._samples = {}
+        self._local = local()
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name: str, byte_count: int = 0):
+        """Times the enclosed block as the given stage."""
+        start = perf_counter()
+        yield
+        self.record(name, perf_counter() - start, byte_count)
+
+    def record(self, name: str, seconds: float, byte_count: int = 0):
+        """Adds one measurement of a stage."""
+        with self._lock:
+            self._add(name, seconds, byte_count)
+            stage = self._get_last_render().setdefault(name, {"seconds": 0.0, "bytes": 0})
+            stage["seconds"] += seconds
+            stage["bytes"] += byte_count
+        if self.callback is not None:
+            self.callback(name, seconds, byte_count)
+
+    def start_render(self):
+        """Starts a new render, so last_render only holds the stages recorded from here on."""
+        with self._lock:
+            self.renders += 1
+            self._local.render = {}
+
+    def add_render(self, render: dict):
+        """Merges the last_render of another RenderStats, e.g. one from a worker process."""
+        with self._lock:
+            self.renders += 1
+            for name, stage in render.items():
+                self._add(name, stage["seconds"], stage["bytes"])
+
+    @property
+    def last_render(self) -> dict:
+        """Returns the per-stage seconds and bytes of the current or last render of the calling thread."""
+        with self._lock:
+            return {name: dict(stage) for name, stage in self._get_last_render().items()}
+
+    def _get_last_render(self) -> dict:
+        """Returns the calling thread's current render."""
+        if not hasattr(self._local, "render"):
+            self._local.render = {}
+        return self._local.render
+
+    def summary(self) -> dict:
+        """Returns count, total, percentiles and bytes per stage, aggregated over every render."""
+        with self._lock:
+            summary = {}
+            for name in sorted(self._counts, key=lambda stage: (STAGES + (stage,)).index(stage)):
+                samples = sorted(self._samples[name])
+                summary[name] = {
+                    "count": self._counts[name],
+                    "total_ms": self._totals[name] * 1000,
+                    "mean_ms": self._totals[name] * 1000 / self._counts[name],
+                    "p50_ms": percentile(samples, 0.50) * 1000,
+                    "p90_ms": percentile(samples, 0.90) * 1000,
+                    "p99_ms": percentile(samples, 0.99) * 1000,
+                    "bytes": self._bytes[name],
+                }
+            return {"renders": self.renders, "stages": summary}
+
+    def to_json(self, path: str):
+        """Writes the summary as JSON."""
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def _add(self, name: str, seconds: float, byte_count: int):
+        if name not in self._counts:
+            self._counts[name] = 0
+            self._totals[name] = 0.0
+            self._bytes[name] = 0
+            self._samples[name] = deque(maxlen=self.window)
+        self._counts[name] += 1
+        self._totals[name] += seconds
+        self._bytes[name] += byte_count
+        self._samples[name].append(seconds)
+
+
+def format_render(render: dict) -> str:
+    """Formats the stages of one render as a short single-line breakdown."""
+    stages = sorted(render, key=lambda stage: (STAGES + (stage,)).index(stage))
+    return "  ".join(f"{name} {render[name]['seconds'] * 1000:.1f} ms" for name in stages)
@@ -0,0 +1,79 @@
+import struct
+
+from PIL import Image, ImageChops, ImageDraw
+
+from watermark import WatermarkTemplate, watermark_region_file
+
+
+def make_image(size=(300, 200)) -> Image:
+    """Returns an RGB image whose three bands differ, so mixed-up planes show."""
+    gradient = Image.linear_gradient("L")
+    return Image.merge("RGB", (gradient.resize(size), gradient.rotate(90).resize(size),
+                               Image.effect_noise(size, 40)))
+
+
+def make_template() -> WatermarkTemplate:
+    """Returns an image template with a half-transparent logo in the bottom-right corner."""
+    logo = Image.new("RGBA", (120, 60), (0, 0, 0, 0))
+    ImageDraw.Draw(logo).ellipse((0, 0, 60, 60), fill=(255, 107, 107, 200))
+    return WatermarkTemplate("image", "bottom-right", 15, 15, watermark_image=logo, size="large")
+
+
+def write_planar_tiff(path, image: Image):
+    """Writes an uncompressed RGB TIFF with PlanarConfiguration 2, one strip per band."""
+    width, height = image.size
+    planes = [band.tobytes() for band in image.split()]
+    entries = 11
+    ifd_offset = 8
+    extra_offset = ifd_offset + 2 + entries * 12 + 4
+    bits_offset = extra_offset
+    offsets_offset = bits_offset + 6
+    counts_offset = offsets_offset + 12
+    data_offset = counts_offset + 12
+    strip_offsets = [data_offset + index * width * height for index in range(3)]
+
+    def entry(tag, kind, count, value):
+        if kind == 3 and count == 1:
+            return struct.pack("<HHIHH", tag, kind, count, value, 0)
+        return struct.pack("<HHII", tag, kind, count, value)
+
+    ifd = [entry(256, 4, 1, width), entry(257, 4, 1, height), entry(258, 3, 3, bits_offset), entry(259, 3, 1, 1),
+           entry(262, 3, 1, 2), entry(273, 4, 3, offsets_offset), entry(277, 3, 1, 3),
+           entry(278, 4, 1, height), entry(279, 4, 3, counts_offset), entry(284, 3, 1, 2),
+           entry(339, 3, 1, 1)]
+    with open(path, "wb") as file:
+        file.write(b"II*\0" + struct.pack("<I", ifd_offset))
+        file.write(struct.pack("<H", entries) + b"".join(ifd) + struct.pack("<I", 0))
+        file.write(struct.pack("<3H", 8, 8, 8))
+        file.write(struct.pack("<3I", *strip_offsets))
+        file.write(struct.pack("<3I", *[width * height] * 3))
+        for plane in planes:
+            file.write(plane)
+
+
+def assert_matches_full_decode(source_path, output_path, template: WatermarkTemplate):
+    """Checks the region output against watermarking a full decode of the source."""
+    if not watermark_region_file(str(source_path), str(output_path), template):
+        return
+    expected = template.apply(Image.open(source_path).convert("RGB"))
+    assert ImageChops.difference(expected, Image.open(output_path).convert("RGB")).getbbox() is None
+
+
+def test_region_matches_full_decode_for_chunky_tiff(tmp_path):
+    source_path = tmp_path / "chunky.tif"
+    make_image().save(source_path)
+    assert_matches_full_decode(source_path, tmp_path / "out.tif", make_template())
+
+
+def test_region_matches_full_decode_for_planar_tiff(tmp_path):
+    source_path = tmp_path / "planar.tif"
+    image = make_image()
+    write_planar_tiff(source_path, image)
+    assert ImageChops.difference(Image.open(source_path).convert("RGB"), image).getbbox() is None
+    assert_matches_full_decode(source_path, tmp_path / "out.tif", make_template())
+
+
+def test_region_matches_full_decode_for_bottom_up_bmp(tmp_path):
+    source_path = tmp_path / "bottom_up.bmp"
+    make_image().save(source_path)
+    assert_matches_full_decode(source_path, tmp_path / "out.bmp", make_template())
@@ -1,13 +1,21 @@
 import tkinter as tk
 from tkinter import filedialog as fd
 from tkinter import colorchooser
+from tkinter import messagebox
+from tkinter import ttk
+from PIL import ImageTk
 from watermark import *
-from threading import Thread
-from time import sleep
+from stats import RenderStats, format_render
+from threading import Thread, Event
+from queue import Queue, Empty
 
 BG = "#41AEA9"
 FG = "#E8FFFF"
 FONT_TYPE = "Helvetica Neue"
+PREVIEW_DEBOUNCE_MS = 80
+PREVIEW_POLL_MS = 15
+EXPORT_POLL_MS = 50
+SUBSAMPLING_OPTIONS = ("4:4:4", "4:2:2", "4:2:0")
 
 
 class EZMark(tk.Tk):
@@ -17,7 +25,7 @@ class EZMark(tk.Tk):
         self.config(background=BG)
         self.minsize(500, 750)
         self.maxsize(500, 750)
-        self.watermark_engine = Watermarker()
+        self.watermark_engine = Watermarker(stats=RenderStats())
         self.text_start_image_path = None
         self.image_start_image_path = None
         self.text_start_image_path = None
@@ -36,6 +44,16 @@ class EZMark(tk.Tk):
         self.preview_width = None
         self.preview_height = None
         self.result_img = None
+        self.preview_after_id = None
+        self.preview_generation = 0
+        self.preview_requests = Queue()
+        self.preview_results = Queue()
+        self.preview_poll_id = None
+        self.preview_pending = False
+        self.export_settings = dict(EXPORT_DEFAULTS)
+        self.export_thread = None
+        self.export_cancel = Event()
+        self.export_updates = Queue()
 
         # Put the base frame on screen, initialize the other screens and display the welcome page
         container = tk.Frame(self, background=BG, width=500, height=750)
@@ -51,7 +69,7 @@ class EZMark(tk.Tk):
             frame.grid(row=0, column=0, sticky="nsew")
         self.show_frame("WelcomePage")
 
-        self.thread = Thread(target=self.update_preview)
+        self.thread = Thread(target=self.render_previews)
         self.thread.daemon = True
         self.thread.start()
 
@@ -66,6 +84,7 @@ class EZMark(tk.Tk):
             self.frames["TextWatermarkScreen"].image_text_entry.delete(0, tk.END)
             self.text_start_image_path = None
             self.image_start_image_path = None
+        self.schedule_preview()
 
     def open_start_image_file_dialog(self, mode):
         """Handles the base image import into the program."""
@@ -75,71 +94,208 @@ class EZMark(tk.Tk):
                 self.text_start_image_path = file.name
             if mode == "image":
                 self.image_start_image_path = file.name
+            self.schedule_preview()
         self.update()
 
     def save_result_img(self, mode):
-        """Saves the result file in the desired location."""
-        file = fd.asksaveasfile(mode='w', defaultextension=".png")
-        if file:
-            if mode == "text":
-                text = self.frames["TextWatermarkScreen"].image_text_entry.get()
-                if text == "":
-                    text = None
-                self.result_img = self.watermark_engine.place_text_watermark(image=Image.open(self.text_start_image_path),
-                                                                             font_size=self.font_size,
-                                                                             position=self.frames["TextWatermarkScreen"].clicked.get(),
-                                                                             margin_y=self.margin_y, margin_x=self.margin_x,
-                                                                             colour=self.watermark_colour, text=text)
-            elif mode == "image":
-                self.result_img = self.watermark_engine.place_image_watermark(image=Image.open(self.image_start_image_path),
-                                                                              watermark_image=Image.open(self.watermark_path),
-                                                                              size=self.frames["ImageWatermarkScreen"].clicked_size.get(),
-                                                                              position=self.frames["ImageWatermarkScreen"].clicked.get(),
-                                                                              margin_x=self.margin_x, margin_y=self.margin_y)
-            self.result_img.save(file.name)
+        """Exports the watermarked image to the chosen location on a background thread."""
+        if self.export_thread is not None and self.export_thread.is_alive():
+            return
+        request = self.watermark_request(mode)
+        if request is None:
+            return
+        output_path = fd.asksaveasfilename(defaultextension=".png",
+                                           filetypes=[('PNG', '.png'), ('JPEG', ('.jpg', '.jpeg'))])
+        if not output_path:
+            return
+        self.export_cancel.clear()
+        self.export_thread = Thread(target=self.run_export, args=(output_path, request, dict(self.export_settings)))
+        self.export_thread.daemon = True
+        self.export_thread.start()
+        self.after(EXPORT_POLL_MS, self.collect_export_updates)
+
+    def run_export(self, output_path, request, settings):
+        """Runs the export on the background thread and reports its progress to the main thread."""
+        operation = request["operation"]
+        try:
+            self.watermark_engine.export(output_path=output_path, settings=settings, cancel=self.export_cancel,
+                                         progress=lambda fraction, step: self.export_updates.put(
+                                             (operation, fraction, step, None)),
+                                         **request)
+        except ExportCancelled:
+            self.export_updates.put((operation, 0.0, "cancelled", None))
+        except Exception as error:
+            self.export_updates.put((operation, 0.0, "failed", error))
+
+    def collect_export_updates(self):
+        """Shows the export progress on the screen that started it. Runs on the main thread."""
+        frame = None
+        try:
+            while True:
+                operation, fraction, step, error = self.export_updates.get_nowait()
+                frame = self.frames["TextWatermarkScreen" if operation == "text" else "ImageWatermarkScreen"]
+                frame.export_progress["value"] = fraction * 100
+                frame.export_status.set(step.capitalize())
+                if error is not None:
+                    messagebox.showerror("EZ Mark", f"Could not save the image:\n{error}")
+        except Empty:
+            pass
+        if self.export_thread.is_alive() or not self.export_updates.empty():
+            self.after(EXPORT_POLL_MS, self.collect_export_updates)
+
+    def cancel_export(self):
+        """Asks the running export to stop."""
+        self.export_cancel.set()
+
+    def open_export_settings(self):
+        """Opens a dialog for the encoder settings used when saving."""
+        window = tk.Toplevel(self, background=BG, padx=10, pady=10)
+        window.title("Export settings")
+        quality = tk.IntVar(value=self.export_settings["quality"])
+        subsampling = tk.StringVar(value=self.export_settings["subsampling"])
+        progressive = tk.BooleanVar(value=self.export_settings["progressive"])
+        compress_level = tk.IntVar(value=self.export_settings["compress_level"])
+        optimize = tk.BooleanVar(value=self.export_settings["optimize"])
+        keep_metadata = tk.BooleanVar(value=self.export_settings["keep_metadata"])
+        tk.Label(window, text="JPEG quality:", background=BG, fg=FG).grid(column=0, row=0, sticky="E")
+        tk.Scale(window, from_=1, to=95, orient="horizontal", bg=BG, variable=quality).grid(column=1, row=0,
+                                                                                            sticky="W")
+        tk.Label(window, text="JPEG subsampling:", background=BG, fg=FG).grid(column=0, row=1, sticky="E")
+        tk.OptionMenu(window, subsampling, *SUBSAMPLING_OPTIONS).grid(column=1, row=1, sticky="W")
+        tk.Checkbutton(window, text="Progressive JPEG", variable=progressive, background=BG,
+                       fg=FG).grid(column=1, row=2, sticky="W")
+        tk.Label(window, text="PNG compression:", background=BG, fg=FG).grid(column=0, row=3, sticky="E")
+        tk.Scale(window, from_=0, to=9, orient="horizontal", bg=BG, variable=compress_level).grid(column=1, row=3,
+                                                                                                  sticky="W")
+        tk.Checkbutton(window, text="Optimize", variable=optimize, background=BG, fg=FG).grid(column=1, row=4,
+                                                                                             sticky="W")
+        tk.Checkbutton(window, text="Keep metadata and colour profile", variable=keep_metadata, background=BG,
+                       fg=FG).grid(column=1, row=5, sticky="W")
+
+        def apply_settings():
+            self.export_settings = {"quality": quality.get(), "subsampling": subsampling.get(),
+                                    "progressive": progressive.get(), "compress_level": compress_level.get(),
+                                    "optimize": optimize.get(), "keep_metadata": keep_metadata.get()}
+            window.destroy()
+
+        tk.Button(window, text="OK", background=BG, highlightthickness=0,
+                  command=apply_settings).grid(column=1, row=6, sticky="E")
 
     def open_watermark_image(self):
         """Imports the watermark image into the program"""
         file = fd.askopenfile(mode='r', filetypes=[('image files', ('.png', '.jpg', '.JPEG'))])
         if file:
             self.watermark_path = file.name
+            self.schedule_preview()
 
     def choose_colour(self):
         """Handles the font color pick prompt"""
-        self.watermark_colour = colorchooser.askcolor()
-        self.watermark_colour = self.watermark_colour[1]
+        colour = colorchooser.askcolor()[1]
+        if colour is not None:
+            self.watermark_colour = colour
+            self.schedule_preview()
         self.update()
 
-    def update_preview(self):
-        """Periodically updates the preview image"""
+    def schedule_preview(self, *args):
+        """Requests a preview re-render, coalescing bursts of changes into a single render."""
+        if self.preview_after_id is not None:
+            self.after_cancel(self.preview_after_id)
+        self.preview_after_id = self.after(PREVIEW_DEBOUNCE_MS, self.request_preview)
+
+    def request_preview(self):
+        """Snapshots the current inputs on the main thread and hands them to the render thread."""
+        self.preview_after_id = None
+        self.preview_generation += 1
+        self.preview_pending = False
+        if self.current_frame == "TextWatermarkScreen":
+            request = self.watermark_request("text")
+        elif self.current_frame == "ImageWatermarkScreen":
+            request = self.watermark_request("image")
+        else:
+            request = None
+        if request is None:
+            return
+        self.preview_pending = True
+        self.preview_requests.put((self.preview_generation, request))
+        if self.preview_poll_id is None:
+            self.preview_poll_id = self.after(PREVIEW_POLL_MS, self.collect_preview)
+
+    def watermark_request(self, mode):
+        """Snapshots the watermark inputs of the given screen, or returns None if no base image is chosen."""
+        if mode == "text" and self.text_start_image_path is not None:
+            text = self.frames["TextWatermarkScreen"].image_text_entry.get()
+            if text == "":
+                text = None
+            return dict(operation="text",
+                        path=self.text_start_image_path,
+                        position=self.frames["TextWatermarkScreen"].clicked.get(),
+                        margin_x=self.margin_x,
+                        margin_y=self.margin_y,
+                        font_size=self.frames["TextWatermarkScreen"].font_scale.get(),
+                        text=text,
+                        colour=self.watermark_colour)
+        elif mode == "image" and self.image_start_image_path is not None:
+            return dict(operation="image",
+                        path=self.image_start_image_path,
+                        position=self.frames["ImageWatermarkScreen"].clicked.get(),
+                        margin_x=self.margin_x,
+                        margin_y=self.margin_y, watermark_path=self.watermark_path,
+                        image_size=self.frames["ImageWatermarkScreen"].clicked_size.get())
+        return None
+
+    def render_previews(self):
+        """Renders preview requests on a background thread, skipping any that were superseded."""
         while True:
-            if self.frames[self.current_frame].__class__.__name__ == "TextWatermarkScreen" and self.text_start_image_path is not None:
-                text = self.frames["TextWatermarkScreen"].image_text_entry.get()
-                if text == "":
-                    text = None
-                self.watermark_engine.watermark_preview(controller=self, operation="text",
-                                                        path=self.text_start_image_path,
-                                                        position=self.frames["TextWatermarkScreen"].clicked.get(),
-                                                        margin_x=self.margin_x,
-                                                        margin_y=self.margin_y,
-                                                        font_size=self.frames["TextWatermarkScreen"].font_scale.get(),
-                                                        text=text,
-                                                        colour=self.watermark_colour)
-                self.text_preview_image = tk.PhotoImage(file=TEXT_PREVIEW_PATH)
-                self.frames["TextWatermarkScreen"].preview_canvas.create_image(250, 250, anchor="center",
-                                                                               image=self.text_preview_image)
-            elif self.frames[self.current_frame].__class__.__name__ == "ImageWatermarkScreen" and self.image_start_image_path is not None:
-                self.watermark_engine.watermark_preview(controller=self, operation="image",
-                                                        path=self.image_start_image_path,
-                                                        position=self.frames["ImageWatermarkScreen"].clicked.get(),
-                                                        margin_x=self.margin_x,
-                                                        margin_y=self.margin_y, watermark_path=self.watermark_path,
-                                                        image_size=self.frames[
-                                                            "ImageWatermarkScreen"].clicked_size.get())
-                self.image_preview_image = tk.PhotoImage(file=IMAGE_PREVIEW_PATH)
-                self.frames["ImageWatermarkScreen"].preview_canvas.create_image(250, 250, anchor="center",
-                                                                                image=self.image_preview_image)
-            sleep(0.01)
+            generation, request = self.preview_requests.get()
+            while not self.preview_requests.empty():
+                generation, request = self.preview_requests.get_nowait()
+            if generation != self.preview_generation:
+                continue
+            try:
+                preview_img = self.watermark_engine.watermark_preview(controller=self, in_memory=True, **request)
+            except Exception as error:
+                self.preview_results.put((generation, request["operation"], None, None, error))
+            else:
+                render = self.watermark_engine.stats.last_render
+                self.preview_results.put((generation, request["operation"], preview_img, render, None))
+
+    def collect_preview(self):
+        """Puts the newest finished preview on the canvas. Runs on the main thread while renders are pending."""
+        self.preview_poll_id = None
+        result = None
+        try:
+            while True:
+                result = self.preview_results.get_nowait()
+        except Empty:
+            pass
+        if result is not None and result[0] == self.preview_generation:
+            generation, operation, preview_img, render, error = result
+            self.preview_pending = False
+            if error is None:
+                self.show_preview(operation, preview_img, render)
+            else:
+                self.show_preview_error(operation, error)
+        if not self.preview_pending:
+            return
+        self.preview_poll_id = self.after(PREVIEW_POLL_MS, self.collect_preview)
+
+    def show_preview(self, operation, preview_img, render):
+        """Displays the rendered preview of the given operation on its canvas, with its per-stage timings."""
+        if operation == "text":
+            self.text_preview_image = ImageTk.PhotoImage(preview_img)
+            self.frames["TextWatermarkScreen"].preview_canvas.create_image(250, 250, anchor="center",
+                                                                           image=self.text_preview_image)
+            self.frames["TextWatermarkScreen"].stats_text.set(format_render(render))
+        elif operation == "image":
+            self.image_preview_image = ImageTk.PhotoImage(preview_img)
+            self.frames["ImageWatermarkScreen"].preview_canvas.create_image(250, 250, anchor="center",
+                                                                            image=self.image_preview_image)
+            self.frames["ImageWatermarkScreen"].stats_text.set(format_render(render))
+
+    def show_preview_error(self, operation, error):
+        """Tells on the stats line of the operation's screen that the preview could not be rendered."""
+        frame = self.frames["TextWatermarkScreen" if operation == "text" else "ImageWatermarkScreen"]
+        frame.stats_text.set(f"Preview failed: {error}")
 
 
 class WelcomePage(tk.Frame):
@@ -192,6 +348,9 @@ class TextWatermarkScreen(tk.Frame):
         self.preview_canvas_image = self.preview_canvas.create_image(250, 250, anchor="center",
                                                                      image=self.controller.one)
         self.preview_canvas.pack()
+        self.stats_text = tk.StringVar()
+        stats_label = tk.Label(self, textvariable=self.stats_text, background=BG, font=(FONT_TYPE, 10), fg=FG)
+        stats_label.pack()
         bottom_frame = tk.Frame(self, background=BG, width=500, padx=10, pady=10)
         base_img = tk.Label(bottom_frame, text="Starting image:", background=BG, font=(FONT_TYPE, 16), fg=FG)
         browse_base_img = tk.Button(bottom_frame, text="Browse Image",
@@ -202,12 +361,15 @@ class TextWatermarkScreen(tk.Frame):
         browse_base_img.grid(column=1, row=0, sticky="W")
         image_text = tk.Label(bottom_frame, text="Watermark text:", background=BG, font=(FONT_TYPE, 16), fg=FG)
         image_text.grid(column=0, row=1, sticky="E")
-        self.image_text_entry = tk.Entry(bottom_frame, highlightthickness=0)
+        self.image_text = tk.StringVar()
+        self.image_text.trace_add("write", self.controller.schedule_preview)
+        self.image_text_entry = tk.Entry(bottom_frame, highlightthickness=0, textvariable=self.image_text)
         self.image_text_entry.grid(column=1, row=1, sticky="E")
         position_text = tk.Label(bottom_frame, text="Watermark position:", background=BG, font=(FONT_TYPE, 16), fg=FG)
         position_text.grid(column=0, row=2, sticky="E")
         self.clicked = tk.StringVar()
         self.clicked.set("top-left")
+        self.clicked.trace_add("write", self.controller.schedule_preview)
         position_drop = tk.OptionMenu(bottom_frame, self.clicked, "top-left", "top-right", "bottom-left",
                                       "bottom-right")
         position_drop.grid(column=1, row=2, sticky="W")
@@ -218,13 +380,26 @@ class TextWatermarkScreen(tk.Frame):
         colour_button.grid(column=1, row=3, sticky="W")
         font_text = tk.Label(bottom_frame, text="Font size:", background=BG, font=(FONT_TYPE, 16), fg=FG)
         font_text.grid(column=0, row=4, sticky="E")
-        self.font_scale = tk.Scale(bottom_frame, from_=0, to=500, orient="horizontal", bg=BG)
+        self.font_scale = tk.Scale(bottom_frame, from_=0, to=500, orient="horizontal", bg=BG,
+                                   command=self.controller.schedule_preview)
         self.font_scale.grid(column=1, row=4, sticky="W")
         bottom_frame.pack()
         save_frame = tk.Frame(self, background=BG, width=500, padx=10, pady=10)
         save_button = tk.Button(save_frame, text="Save Image", background=BG, highlightthickness=0,
                                 command=lambda: self.controller.save_result_img("text"))
-        save_button.pack()
+        save_button.grid(column=0, row=0)
+        cancel_button = tk.Button(save_frame, text="Cancel", background=BG, highlightthickness=0,
+                                  command=self.controller.cancel_export)
+        cancel_button.grid(column=1, row=0)
+        settings_button = tk.Button(save_frame, text="Export Settings", background=BG, highlightthickness=0,
+                                    command=self.controller.open_export_settings)
+        settings_button.grid(column=2, row=0)
+        self.export_progress = ttk.Progressbar(save_frame, orient="horizontal", length=300, maximum=100)
+        self.export_progress.grid(column=0, row=1, columnspan=2)
+        self.export_status = tk.StringVar()
+        export_status_label = tk.Label(save_frame, textvariable=self.export_status, background=BG,
+                                       font=(FONT_TYPE, 12), fg=FG)
+        export_status_label.grid(column=2, row=1)
         save_frame.pack()
 
 
@@ -243,6 +418,9 @@ class ImageWatermarkScreen(tk.Frame):
         self.preview_canvas_image = self.preview_canvas.create_image(250, 250, anchor="center",
                                                                      image=self.controller.one)
         self.preview_canvas.pack()
+        self.stats_text = tk.StringVar()
+        stats_label = tk.Label(self, textvariable=self.stats_text, background=BG, font=(FONT_TYPE, 10), fg=FG)
+        stats_label.pack()
         bottom_frame = tk.Frame(self, background=BG, width=500, padx=10, pady=10)
         base_img = tk.Label(bottom_frame, text="Starting image:", background=BG, font=(FONT_TYPE, 16), fg=FG)
         browse_base_img = tk.Button(bottom_frame, text="Browse Image",
@@ -262,6 +440,7 @@ class ImageWatermarkScreen(tk.Frame):
         position_text.grid(column=0, row=2, sticky="E")
         self.clicked = tk.StringVar()
         self.clicked.set("top-left")
+        self.clicked.trace_add("write", self.controller.schedule_preview)
         position_drop = tk.OptionMenu(bottom_frame, self.clicked, "top-left", "top-right", "bottom-left",
                                       "bottom-right")
         position_drop.grid(column=1, row=2, sticky="W")
@@ -269,11 +448,24 @@ class ImageWatermarkScreen(tk.Frame):
         watermark_size_text.grid(column=0, row=3, sticky="E")
         self.clicked_size = tk.StringVar()
         self.clicked_size.set("large")
+        self.clicked_size.trace_add("write", self.controller.schedule_preview)
         size_drop = tk.OptionMenu(bottom_frame, self.clicked_size, "large", "medium", "small")
         size_drop.grid(column=1, row=3, sticky="W")
         bottom_frame.pack()
         save_frame = tk.Frame(self, background=BG, width=500, padx=10, pady=10)
         save_button = tk.Button(save_frame, text="Save Image", background=BG, highlightthickness=0,
                                 command=lambda: self.controller.save_result_img("image"))
-        save_button.pack()
+        save_button.grid(column=0, row=0)
+        cancel_button = tk.Button(save_frame, text="Cancel", background=BG, highlightthickness=0,
+                                  command=self.controller.cancel_export)
+        cancel_button.grid(column=1, row=0)
+        settings_button = tk.Button(save_frame, text="Export Settings", background=BG, highlightthickness=0,
+                                    command=self.controller.open_export_settings)
+        settings_button.grid(column=2, row=0)
+        self.export_progress = ttk.Progressbar(save_frame, orient="horizontal", length=300, maximum=100)
+        self.export_progress.grid(column=0, row=1, columnspan=2)
+        self.export_status = tk.StringVar()
+        export_status_label = tk.Label(save_frame, textvariable=self.export_status, background=BG,
+                                       font=(FONT_TYPE, 12), fg=FG)
+        export_status_label.grid(column=2, row=1)
         save_frame.pack()
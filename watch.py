@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from batch import MAX_CRASHES, _init_worker, add_file_arguments, check_file_arguments, check_spec, \
+    collect_inputs, get_input_root, report, spec_from_args, watermark_file
+from watermark import get_output_path
+
+MANIFEST_NAME = ".ezmark-manifest.json"
+POLL_INTERVAL = 2.0
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path: str) -> str:
+    """Returns the SHA-256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def spec_hash(spec: dict) -> str:
+    """Returns a hash of everything that affects the output, including the content of the watermark image."""
+    spec = dict(spec)
+    if spec.get("watermark_path") is not None:
+        spec["watermark_hash"] = file_hash(spec["watermark_path"])
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+class Manifest:
+    """Remembers which inputs were watermarked with which spec, persisted as JSON across restarts.
+
+    Each input path maps to its size, modification time and content hash and to the hash of the spec its output
+    was made with. Size and modification time let unchanged files be skipped without reading them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.entries = json.load(file)
+
+    def is_current(self, path: str, stat, spec_digest: str) -> bool:
+        """Tells if the input's output exists and was made from the same content with the same spec.
+
+        Inputs that failed are also current until they or the spec change, so they are not retried on every scan.
+        Only hashes the file if its size or modification time changed; a file that was merely touched has its
+        entry refreshed.
+        """
+        entry = self.entries.get(path)
+        if entry is None or entry["spec_hash"] != spec_digest:
+            return False
+        if entry["error"] is None and not os.path.exists(entry["output"]):
+            return False
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+        if entry["size"] != stat.st_size or entry["content_hash"] != file_hash(path):
+            return False
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def record(self, path: str, stat, content_hash, spec_digest: str, output_path=None, error=None):
+        """Stores the state of an input that was just watermarked, or failed to be."""
+        self.entries[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "content_hash": content_hash,
+                              "spec_hash": spec_digest,
+                              "output": None if output_path is None else os.path.abspath(output_path),
+                              "error": None if error is None else repr(error)}
+
+    def forget_missing(self, paths):
+        """Drops the entries of inputs that are no longer there."""
+        for path in set(self.entries) - set(paths):
+            del self.entries[path]
+
+    def save(self):
+        """Writes the manifest atomically."""
+        temporary_path = self.path + ".part"
+        with open(temporary_path, "w") as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(temporary_path, self.path)
+
+
+def _scan(inputs, manifest: Manifest, spec_digest: str, last_seen: dict):
+    """Returns the inputs that need watermarking, with their stat results, and how many are not settled yet.
+
+    A file is only picked up once its size and modification time stayed the same over two scans, so files that
+    are still being copied in are left alone.
+    """
+    paths = collect_inputs(inputs)
+    manifest.forget_missing(paths)
+    pending = []
+    unsettled = 0
+    seen = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        seen[path] = (stat.st_size, stat.st_mtime_ns)
+        if last_seen.get(path) != seen[path]:
+            unsettled += 1
+            continue
+        if not manifest.is_current(path, stat, spec_digest):
+            pending.append((path, stat))
+    last_seen.clear()
+    last_seen.update(seen)
+    return pending, unsettled
+
+
+def _watermark_new_file(path: str, output_path: str, spec: dict):
+    """Hashes and watermarks one input in a worker process. Returns the output path and the content hash."""
+    content_hash = file_hash(path)
+    output_path, render = watermark_file(path, output_path, spec)
+    return output_path, content_hash
+
+
+async def watch_folder(inputs, output_dir: str, spec: dict, manifest_path: str = None,
+                       interval: float = POLL_INTERVAL, workers: int = None, once: bool = False):
+    """Keeps watermarking new or changed images found in the inputs until cancelled.
+
+    The inputs are polled every interval seconds. Inputs whose content and spec match the manifest are skipped,
+    so restarting, or changing the spec, only redoes the outputs that are actually out of date. With once set,
+    returns after the first pass that finds nothing left to do.
+
+    When a worker process dies, the pool is rebuilt and the inputs it was working on are retried one at a time
+    on the next scans; an input is only recorded as failed once it crashed the pool MAX_CRASHES times on its own.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(manifest_path or os.path.join(output_dir, MANIFEST_NAME))
+    spec_digest = spec_hash(spec)
+    input_root = get_input_root(inputs)
+    last_seen = {}
+    crashes = {}
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec,))
+    try:
+        while True:
+            pending, unsettled = await loop.run_in_executor(None, _scan, inputs, manifest, spec_digest, last_seen)
+            fresh = [(path, stat) for path, stat in pending if path not in crashes]
+            batches = ([fresh] if fresh else []) + [[(path, stat)] for path, stat in pending if path in crashes]
+            for batch in batches:
+                jobs = [loop.run_in_executor(pool, _watermark_new_file, path,
+                                             get_output_path(path, input_root, output_dir), spec)
+                        for path, stat in batch]
+                outcomes = await asyncio.gather(*jobs, return_exceptions=True)
+                for (path, stat), outcome in zip(batch, outcomes):
+                    if isinstance(outcome, BrokenProcessPool):
+                        crashes[path] = crashes.get(path, 0) + (1 if len(batch) == 1 else 0)
+                        if crashes[path] < MAX_CRASHES:
+                            continue
+                    if isinstance(outcome, Exception):
+                        manifest.record(path, stat, None, spec_digest, error=outcome)
+                        report(path, None, outcome)
+                    else:
+                        output_path, content_hash = outcome
+                        manifest.record(path, stat, content_hash, spec_digest, output_path)
+                        report(path, output_path, None)
+                    crashes.pop(path, None)
+                if any(isinstance(outcome, BrokenProcessPool) for outcome in outcomes):
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(spec,))
+            await loop.run_in_executor(None, manifest.save)
+            if once and not pending and not unsettled:
+                return
+            await asyncio.sleep(interval)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Watch folders and watermark new or changed images as they arrive.")
+    add_file_arguments(parser)
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="seconds between scans")
+    parser.add_argument("--manifest", help=f"manifest file (defaults to {MANIFEST_NAME} in the output directory)")
+    parser.add_argument("--once", action="store_true", help="exit once everything is up to date")
+    args = parser.parse_args(argv)
+    check_file_arguments(parser, args)
+    check_spec(parser, spec_from_args(args))
+    try:
+        asyncio.run(watch_folder(args.inputs, args.output, spec_from_args(args), manifest_path=args.manifest,
+                                 interval=args.interval, workers=args.workers, once=args.once))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
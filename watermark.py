@@ -1,86 +1,385 @@
-from PIL import ImageFont, ImageDraw, ImageFilter, Image
+import os
+import shutil
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from time import perf_counter
+
+from PIL import ImageFont, ImageDraw, ImageFilter, ImageColor, Image
+
+from stats import NULL_STAGE, RenderStats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 TEXT_PREVIEW_PATH = ".temporary/text_preview_img.png"
 IMAGE_PREVIEW_PATH = ".temporary/image_preview_img.png"
+PREVIEW_SIZE = 500
+PREVIEW_CACHE_SIZE = 8
+FONT_PATH = "helveticaneue.ttf"
+FONT_CACHE_SIZE = 32
+TEXT_METRICS_CACHE_SIZE = 256
+TEXT_LAYER_CACHE_SIZE = 32
+TEMPLATE_CACHE_SIZE = 16
+WATERMARK_SIZES = {"large": 0.15, "medium": 0.10, "small": 0.05}
+DRAFT_REDUCING_GAP = 2
+REGION_MODES = ("L", "LA", "RGB", "RGBA")
+REGION_BAND_ROWS = 256
+TILE_ANGLE = 30
+JPEG_MODES = ("L", "RGB", "CMYK")
+EXPORT_DEFAULTS = {"quality": 90, "subsampling": "4:2:0", "progressive": False, "compress_level": 6,
+                   "optimize": False, "keep_metadata": True}
+DERIVATIVE_SIZES = (None, 2048, 1024, 400)
+
+
+class ExportCancelled(Exception):
+    """Raised when an export is cancelled before it finished."""
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path: str, font_size: int):
+    """Loads a TrueType font, reusing already parsed fonts of the same file and size."""
+    return ImageFont.truetype(font_path, font_size)
+
+
+@lru_cache(maxsize=TEXT_METRICS_CACHE_SIZE)
+def _measure_text(font, text_string: str):
+    """Returns the rendered width and height of a string, rasterising it only once per font and text."""
+    # https://stackoverflow.com/a/46220683/9263761
+    ascent, descent = font.getmetrics()
+    bbox = font.getmask(text_string).getbbox()
+    return bbox[2], bbox[3] + descent
+
+
+@lru_cache(maxsize=TEXT_LAYER_CACHE_SIZE)
+def render_text_layer(font_path: str, font_size: int, text: str, colour: str) -> Image:
+    """Renders the text once into a transparent RGBA layer. The returned layer is shared and must not be modified."""
+    font = load_font(font_path, font_size)
+    left, top, right, bottom = font.getbbox(text)
+    layer = Image.new("RGBA", (max(1, right), max(1, bottom)), ImageColor.getrgb(colour)[:3] + (0,))
+    ImageDraw.Draw(layer).text((0, 0), text, colour, font=font)
+    return layer
+
+
+def fit_size(size, max_size):
+    """Returns the largest size with the aspect ratio of size that fits into max_size, never upscaling."""
+    width, height = size
+    max_width, max_height = max_size
+    scale = min(max_width / width, max_height / height, 1)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def decode_scaled(image: Image, size) -> Image:
+    """Decodes an opened image at the given size.
+
+    When the target is much smaller than the source, JPEG images are decoded at 1/2, 1/4 or 1/8 scale by the
+    decoder itself, leaving only a single high-quality resample to reach the exact size.
+    """
+    if size == image.size:
+        image.load()
+        return image
+    if image.format == "JPEG":
+        image.draft(image.mode, (size[0] * DRAFT_REDUCING_GAP, size[1] * DRAFT_REDUCING_GAP))
+    return image.resize(size, Image.LANCZOS)
+
+
+def open_image(path: str, max_size=None) -> Image:
+    """Opens and decodes an image, fitting it into max_size through a reduced-resolution decode when given."""
+    image = Image.open(path)
+    if max_size is None:
+        image.load()
+        return image
+    return decode_scaled(image, fit_size(image.size, max_size))
+
+
+def get_output_path(path: str, input_root: str, output_dir: str) -> str:
+    """Returns where the output of an input goes, keeping its path relative to the input root.
+
+    Inputs with the same name in different directories thereby get outputs of their own.
+    """
+    return os.path.join(output_dir, os.path.relpath(path, input_root))
+
+
+def get_common_root(paths) -> str:
+    """Returns the deepest directory containing every path."""
+    return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+
+
+def get_save_options(path: str, image: Image = None, settings: dict = None, image_format: str = None) -> dict:
+    """Returns the Image.save keyword arguments for the format implied by the path's extension.
+
+    image_format takes precedence over the path, which may then be None. settings override EXPORT_DEFAULTS. With
+    keep_metadata, the ICC profile and EXIF data of the image are passed through to formats that can store them.
+    """
+    settings = dict(EXPORT_DEFAULTS, **(settings or {}))
+    if image_format is None:
+        image_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    options = {"format": image_format}
+    if image_format == "JPEG":
+        options.update(quality=settings["quality"], subsampling=settings["subsampling"],
+                       progressive=settings["progressive"], optimize=settings["optimize"])
+    elif image_format == "PNG":
+        options.update(compress_level=settings["compress_level"], optimize=settings["optimize"])
+    if settings["keep_metadata"] and image is not None:
+        if image.info.get("icc_profile"):
+            options["icc_profile"] = image.info["icc_profile"]
+        if image.info.get("exif") and image_format in ("JPEG", "PNG", "WEBP", "TIFF"):
+            options["exif"] = image.info["exif"]
+    return options
+
+
+def make_tile_cell(layer: Image, angle: float = TILE_ANGLE, spacing=None, opacity: float = 1.0) -> Image:
+    """Rotates the watermark and lays it out in a cell that tiles into a staggered diagonal pattern."""
+    rotated = apply_opacity(layer.convert("RGBA").rotate(angle, resample=Image.BICUBIC, expand=True), opacity)
+    if spacing is None:
+        spacing = max(rotated.width, rotated.height) // 2
+    cell_width = rotated.width + spacing
+    cell_height = rotated.height + spacing
+    cell = Image.new("RGBA", (cell_width, 2 * cell_height), (0, 0, 0, 0))
+    cell.paste(rotated, (0, 0))
+    cell.paste(rotated, (cell_width // 2, cell_height))
+    cell.paste(rotated, (cell_width // 2 - cell_width, cell_height))
+    return cell
+
+
+def apply_opacity(layer: Image, opacity: float) -> Image:
+    """Returns the layer as RGBA with its alpha channel scaled by the opacity."""
+    if layer.mode != "RGBA":
+        layer = layer.convert("RGBA")
+    if opacity >= 1:
+        return layer
+    red, green, blue, alpha = layer.split()
+    return Image.merge("RGBA", (red, green, blue, alpha.point(lambda value: int(value * opacity + 0.5))))
+
+
+def tile_layer(cell: Image, xy, size) -> Image:
+    """Returns an RGBA layer of the given size cut from the cell tiled over the image, starting at corner xy."""
+    if np is None:
+        raise RuntimeError("tiled watermarks need NumPy")
+    cell = np.asarray(cell)
+    cell_height, cell_width = cell.shape[:2]
+    x, y = xy[0] % cell_width, xy[1] % cell_height
+    width, height = size
+    repeats = (-(-(y + height) // cell_height), -(-(x + width) // cell_width), 1)
+    return Image.fromarray(np.ascontiguousarray(np.tile(cell, repeats)[y:y + height, x:x + width]), "RGBA")
+
+
+def composite_layer(image: Image, layer: Image, xy=(0, 0), opacity: float = 1.0) -> Image:
+    """Alpha-blends an RGBA layer over the image at xy with the given opacity, in place and in a single pass.
+
+    Images with an alpha channel get proper "over" compositing; everything else is blended through the layer's
+    alpha. Only the region the layer covers is touched.
+    """
+    layer = apply_opacity(layer, opacity)
+    x, y = xy
+    box = (max(x, 0), max(y, 0), min(x + layer.width, image.width), min(y + layer.height, image.height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return image
+    if box != (x, y, x + layer.width, y + layer.height):
+        layer = layer.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+    if image.mode == "RGBA":
+        image.paste(Image.alpha_composite(image.crop(box), layer), box)
+    elif image.mode == "RGB":
+        image.paste(layer, box, layer)
+    elif image.mode == "L":
+        image.paste(layer.convert("L"), box, layer)
+    else:
+        mode = "RGBA" if "A" in image.getbands() else "RGB"
+        region = composite_layer(image.crop(box).convert(mode), layer)
+        image.paste(region.convert(image.mode), box)
+    return image
 
 
 class Watermarker:
 
-    def watermark_preview(self, controller, operation: str, path: str, position: str, margin_x: int, margin_y: int, **kwargs):
-        """Returns a preview of the current state of the watermarking process as an image"""
-        base_img = Image.open(path)
+    def __init__(self, preview_cache_size: int = PREVIEW_CACHE_SIZE, stats: RenderStats = None):
+        self.preview_cache_size = preview_cache_size
+        self.stats = stats
+        self._preview_cache = OrderedDict()
+        self._preview_cache_lock = Lock()
+
+    def watermark_preview(self, controller, operation: str, path: str, position: str, margin_x: int, margin_y: int,
+                          in_memory: bool = False, **kwargs) -> Image:
+        """Returns a preview of the current state of the watermarking process as an image.
+
+        Unless in_memory is set, the preview is also written to TEXT_PREVIEW_PATH or IMAGE_PREVIEW_PATH.
+        """
+        if self.stats is not None:
+            self.stats.start_render()
+        preview_img, scale = self._get_preview_base(path)
+        controller.preview_width, controller.preview_height = preview_img.size
         font_size = kwargs.get("font_size")
         text = kwargs.get("text")
         image_size = kwargs.get("image_size")
         watermark_path = kwargs.get("watermark_path")
         colour = kwargs.get("colour")
+        margin_x = int(margin_x * scale)
+        margin_y = int(margin_y * scale)
 
         if operation == "text":
-            text_preview_img = self.place_text_watermark(image=base_img, font_size=font_size, text=text,
+            text_preview_img = self.place_text_watermark(image=preview_img.copy(),
+                                                         font_size=max(1, round(font_size * scale)), text=text,
                                                          position=position, margin_x=margin_x,
                                                          margin_y=margin_y, colour=colour)
-            text_preview_img = self._convert_to_preview_size(controller=controller, image=text_preview_img)
-            text_preview_img.save(TEXT_PREVIEW_PATH)
+            if not in_memory:
+                self.save_image(text_preview_img, TEXT_PREVIEW_PATH)
+            return text_preview_img
         elif operation == "image":
             if watermark_path is not None:
-                watermark_img = Image.open(watermark_path)
+                watermark_img = self.open_image(watermark_path)
             else:
                 watermark_img = None
-            image_preview_img = self.place_image_watermark(base_img, watermark_img, size=image_size,
+            image_preview_img = self.place_image_watermark(preview_img, watermark_img, size=image_size,
                                                            position=position, margin_x=margin_x, margin_y=margin_y)
-            image_preview_img = self._convert_to_preview_size(controller=controller, image=image_preview_img)
-            image_preview_img.save(IMAGE_PREVIEW_PATH)
+            if not in_memory:
+                self.save_image(image_preview_img, IMAGE_PREVIEW_PATH)
+            return image_preview_img
+
+    def open_image(self, path: str, max_size=None) -> Image:
+        """Opens and decodes an image like open_image, recording the decode stage."""
+        with self._decode_stage(path):
+            return open_image(path, max_size=max_size)
+
+    def save_image(self, image: Image, path, **options):
+        """Encodes and writes the image to a path or a file object, recording the encode stage."""
+        if options.get("format") == "JPEG" and image.mode not in JPEG_MODES:
+            image = image.convert("RGB")
+        if self.stats is None:
+            image.save(path, **options)
+            return
+        is_file = isinstance(path, (str, os.PathLike))
+        offset = 0 if is_file else path.tell()
+        start = perf_counter()
+        image.save(path, **options)
+        seconds = perf_counter() - start
+        self.stats.record("encode", seconds, os.path.getsize(path) if is_file else path.tell() - offset)
+
+    def export(self, operation: str, path: str, output_path: str, position: str, margin_x: int, margin_y: int,
+               settings: dict = None, progress=None, cancel=None, **kwargs) -> str:
+        """Watermarks the base image at full resolution and writes it with the given encoder settings.
+
+        Takes the same watermark arguments as watermark_preview. progress is called with the finished fraction
+        and the next step; once the cancel event is set the export stops before its next step and raises
+        ExportCancelled. The result is written to a temporary file first, so a cancelled or failed export
+        never leaves a partial file behind. Raises ValueError up front if the output extension is not an image
+        format Pillow can write.
+        """
+        def step(fraction: float, name: str):
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelled
+            if progress is not None:
+                progress(fraction, name)
+
+        extension = os.path.splitext(output_path)[1]
+        if Image.registered_extensions().get(extension.lower()) not in Image.SAVE:
+            raise ValueError(f"Unknown image file extension: {extension or '(none)'}")
+        if self.stats is not None:
+            self.stats.start_render()
+        step(0.0, "decoding")
+        image = self.open_image(path)
+        step(0.4, "watermarking")
+        if operation == "text":
+            image = self.place_text_watermark(image=image, font_size=kwargs.get("font_size"),
+                                              position=position, margin_x=margin_x, margin_y=margin_y,
+                                              colour=kwargs.get("colour"), text=kwargs.get("text"))
+        elif operation == "image":
+            watermark_path = kwargs.get("watermark_path")
+            watermark_img = self.open_image(watermark_path) if watermark_path is not None else None
+            image = self.place_image_watermark(image, watermark_img, size=kwargs.get("image_size"),
+                                               position=position, margin_x=margin_x, margin_y=margin_y,
+                                               in_place=True)
+        else:
+            raise ValueError
+        step(0.6, "encoding")
+        temporary_path = output_path + ".part"
+        try:
+            self.save_image(image, temporary_path, **get_save_options(output_path, image, settings))
+            step(1.0, "done")
+            os.replace(temporary_path, output_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return output_path
+
+    def _stage(self, name: str, byte_count: int = 0):
+        """Returns a context manager timing a stage of the hot path, or a no-op one when stats are disabled."""
+        if self.stats is None:
+            return NULL_STAGE
+        return self.stats.stage(name, byte_count)
+
+    def _decode_stage(self, path: str):
+        """Returns the stage context for decoding the file; its size is only looked up when stats are enabled."""
+        if self.stats is None:
+            return NULL_STAGE
+        return self.stats.stage("decode", os.path.getsize(path))
+
+    def clear_preview_cache(self):
+        """Drops every cached preview proxy."""
+        with self._preview_cache_lock:
+            self._preview_cache.clear()
+
+    def _get_preview_base(self, path: str):
+        """Returns the preview-sized proxy of the base image and the proxy/base scale factor.
+
+        Entries are keyed by path and modification time and evicted least recently used first.
+        """
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        with self._preview_cache_lock:
+            entry = self._preview_cache.get(key)
+            if entry is not None:
+                self._preview_cache.move_to_end(key)
+                return entry
+        with self._decode_stage(path):
+            base_img = Image.open(path)
+            base_width = base_img.width
+            preview_img = decode_scaled(base_img, self._get_preview_size(base_img.size))
+        entry = (preview_img, preview_img.width / base_width)
+        with self._preview_cache_lock:
+            self._preview_cache[key] = entry
+            self._preview_cache.move_to_end(key)
+            while len(self._preview_cache) > self.preview_cache_size:
+                self._preview_cache.popitem(last=False)
+        return entry
 
     def place_text_watermark(self, image: Image, font_size: int, position: str, margin_x: int,
-                             margin_y: int, colour: str, text) -> Image:
-        """Adds text watermark to the base image"""
+                             margin_y: int, colour: str, text, prerendered: bool = False) -> Image:
+        """Adds text watermark to the base image.
+
+        With prerendered set, the text is composited from a cached RGBA layer instead of being drawn again.
+        """
         if text is not None:
-            title_font = ImageFont.truetype("helveticaneue.ttf", font_size)
-            image_width, image_height = image.size
-            text_width, text_height = self._get_text_dimensions(text, title_font)
-            if position == "top-left":
-                text_x = margin_x
-                text_y = margin_y
-            elif position == "top-right":
-                text_x = image_width - text_width - margin_x
-                text_y = margin_y
-            elif position == "bottom-left":
-                text_x = margin_x
-                text_y = image_height - text_height - margin_y
-            elif position == "bottom-right":
-                text_x = image_width - text_width - margin_x
-                text_y = image_height - text_height - margin_y
+            with self._stage("font_load"):
+                title_font = load_font(FONT_PATH, font_size)
+            text_size = self._get_text_dimensions(text, title_font)
+            text_x, text_y = self._get_watermark_position(image.size, text_size, position, margin_x, margin_y)
+            if prerendered:
+                with self._stage("text_render"):
+                    text_layer = render_text_layer(FONT_PATH, font_size, text, colour)
+                with self._stage("composite"):
+                    composite_layer(image, text_layer, (text_x, text_y))
             else:
-                raise ValueError
-            image_editable = ImageDraw.Draw(image)
-            image_editable.text((text_x, text_y), text, colour, font=title_font)
+                with self._stage("composite"):
+                    image_editable = ImageDraw.Draw(image)
+                    image_editable.text((text_x, text_y), text, colour, font=title_font)
             return image
         else:
             return image
 
     def place_image_watermark(self, image, watermark_image, size: str,
-                              position: str, margin_x: int, margin_y: int) -> Image:
-        """Adds image watermark to the base image"""
+                              position: str, margin_x: int, margin_y: int, in_place: bool = False) -> Image:
+        """Adds image watermark to the base image, honouring the transparency of the watermark.
+
+        With in_place set, only the region under the watermark is written and the base image is not copied.
+        """
         if watermark_image is not None:
-            image_width, image_height = image.size
-            watermark_image = self._resize_watermark(image_width, watermark_image, size=size)
-            watermark_image_width, watermark_image_height = watermark_image.size
-            image = image.copy()
-            if position == "top-left":
-                wm_x = margin_x
-                wm_y = margin_y
-            elif position == "top-right":
-                wm_x = image_width - watermark_image_width - margin_x
-                wm_y = margin_y
-            elif position == "bottom-left":
-                wm_x = margin_x
-                wm_y = image_height - watermark_image_height - margin_y
-            elif position == "bottom-right":
-                wm_x = image_width - watermark_image_width - margin_x
-                wm_y = image_height - watermark_image_height - margin_y
-            else:
-                raise ValueError
-            image.paste(watermark_image, (wm_x, wm_y))
+            watermark_image = self._resize_watermark(image.width, watermark_image, size=size)
+            wm_x, wm_y = self._get_watermark_position(image.size, watermark_image.size, position, margin_x, margin_y)
+            with self._stage("composite"):
+                if not in_place:
+                    image = image.copy()
+                composite_layer(image, watermark_image, (wm_x, wm_y))
             return image
         else:
             return image
@@ -89,43 +388,311 @@ class Watermarker:
         """Resizes the watermark image into the requested size."""
         watermark_image_width, watermark_image_height = watermark_image.size
         wm_ratio = watermark_image_height / watermark_image_width
-        if size == "large":
-            resized_wm_width = int(image_width * 0.15)
-        elif size == "medium":
-            resized_wm_width = int(image_width * 0.10)
-        elif size == "small":
-            resized_wm_width = int(image_width * 0.05)
-        else:
-            raise ValueError
+        resized_wm_width = self._get_watermark_width(image_width, size)
         resized_wm_height = int(resized_wm_width * wm_ratio)
         new_size = (resized_wm_width, resized_wm_height)
-        resized_wm = watermark_image.resize(new_size)
+        with self._stage("resize"):
+            resized_wm = watermark_image.resize(new_size)
         return resized_wm
 
-    def _get_text_dimensions(self, text_string: str, font):
-        """Returns the dimensions of a string when rendered in pixels."""
-        # https://stackoverflow.com/a/46220683/9263761
-        ascent, descent = font.getmetrics()
+    def _get_watermark_width(self, image_width, size) -> int:
+        """Returns the width of an image watermark of the requested size on an image of the given width."""
+        if size not in WATERMARK_SIZES:
+            raise ValueError
+        return int(image_width * WATERMARK_SIZES[size])
 
-        text_width = font.getmask(text_string).getbbox()[2]
-        text_height = font.getmask(text_string).getbbox()[3] + descent
+    def _get_watermark_position(self, image_size, watermark_size, position: str, margin_x: int, margin_y: int):
+        """Returns the top-left corner of a watermark placed at the requested position of the image."""
+        image_width, image_height = image_size
+        watermark_width, watermark_height = watermark_size
+        if position == "top-left":
+            return margin_x, margin_y
+        elif position == "top-right":
+            return image_width - watermark_width - margin_x, margin_y
+        elif position == "bottom-left":
+            return margin_x, image_height - watermark_height - margin_y
+        elif position == "bottom-right":
+            return image_width - watermark_width - margin_x, image_height - watermark_height - margin_y
+        else:
+            raise ValueError
 
-        return text_width, text_height
+    def _get_text_dimensions(self, text_string: str, font):
+        """Returns the dimensions of a string when rendered in pixels."""
+        with self._stage("text_measure"):
+            return _measure_text(font, text_string)
 
-    def _convert_to_preview_size(self, image: Image, controller) -> Image:
-        """Resizes the image to fit into the preview canvas on the GUI."""
-        width, height = image.size
+    def _get_preview_size(self, size):
+        """Returns the size that fits an image of the given size into the preview canvas on the GUI."""
+        width, height = size
         ratio = width / height
         if ratio > 1:
-            new_width = 500
-            new_height = int(new_width * ratio)
+            new_width = PREVIEW_SIZE
+            new_height = max(1, int(new_width / ratio))
         elif ratio < 1:
-            new_height = 500
-            new_width = int(new_height / ratio)
+            new_height = PREVIEW_SIZE
+            new_width = max(1, int(new_height * ratio))
+        else:
+            new_width = PREVIEW_SIZE
+            new_height = PREVIEW_SIZE
+        return new_width, new_height
+
+
+class WatermarkTemplate:
+    """A watermark spec captured once and applied to many images.
+
+    The rasterised watermark layer is built lazily and cached per resized watermark width, so every image width
+    that maps to the same watermark width shares one layer. Every watermark is blended with composite_layer,
+    which honours the transparency of the logo and of RGBA images; the tiled pattern is built with NumPy.
+    """
+
+    def __init__(self, operation: str, position: str, margin_x: int, margin_y: int, text=None, font_size=None,
+                 colour=None, watermark_image=None, size=None, opacity: float = 1.0, tiled: bool = False,
+                 angle: float = TILE_ANGLE, spacing=None, engine: Watermarker = None,
+                 cache_size: int = TEMPLATE_CACHE_SIZE):
+        if operation not in ("text", "image"):
+            raise ValueError
+        self.operation = operation
+        self.position = position
+        self.margin_x = margin_x
+        self.margin_y = margin_y
+        self.text = text
+        self.font_size = font_size
+        self.colour = colour
+        self.watermark_image = watermark_image
+        self.size = size
+        self.opacity = opacity
+        self.tiled = tiled
+        self.angle = angle
+        self.spacing = spacing
+        self.engine = engine if engine is not None else Watermarker()
+        self.cache_size = cache_size
+        self._layers = OrderedDict()
+        self._layers_lock = Lock()
+
+    @classmethod
+    def from_spec(cls, spec: dict, engine: Watermarker = None):
+        """Builds a template from a watermark spec dict as used by the batch tools."""
+        engine = engine if engine is not None else Watermarker()
+        watermark_image = None
+        if spec["operation"] == "image" and spec.get("watermark_path") is not None:
+            watermark_image = engine.open_image(spec["watermark_path"])
+        return cls(operation=spec["operation"], position=spec["position"], margin_x=spec["margin_x"],
+                   margin_y=spec["margin_y"], text=spec.get("text"), font_size=spec.get("font_size"),
+                   colour=spec.get("colour"), watermark_image=watermark_image, size=spec.get("image_size"),
+                   opacity=spec.get("opacity", 1.0), tiled=spec.get("tiled", False),
+                   angle=spec.get("angle", TILE_ANGLE), spacing=spec.get("spacing"), engine=engine)
+
+    def get_layer(self, image_width: int):
+        """Returns the watermark layer for an image of the given width, or None if there is nothing to place."""
+        if self.operation == "text":
+            if self.text is None:
+                return None
+            return self._get_cached(("layer", None), self._render_text_layer)
+        if self.watermark_image is None:
+            return None
+        key = ("layer", self.engine._get_watermark_width(image_width, self.size))
+        return self._get_cached(key, lambda: self.engine._resize_watermark(image_width, self.watermark_image,
+                                                                            size=self.size))
+
+    def _render_text_layer(self):
+        with self.engine._stage("text_render"):
+            return render_text_layer(FONT_PATH, self.font_size, self.text, self.colour)
+
+    def get_tile_cell(self, image_width: int):
+        """Returns the seamlessly tiling cell of the tiled watermark for an image of the given width, or None."""
+        layer = self.get_layer(image_width)
+        if layer is None:
+            return None
+        key = ("tile", layer.size)
+        return self._get_cached(key, lambda: make_tile_cell(layer, self.angle, self.spacing, self.opacity))
+
+    def _get_cached(self, key, build):
+        """Returns the cached value for the key, building it and evicting the least recently used one on a miss."""
+        with self._layers_lock:
+            value = self._layers.get(key)
+            if value is not None:
+                self._layers.move_to_end(key)
+                return value
+        value = build()
+        with self._layers_lock:
+            self._layers[key] = value
+            self._layers.move_to_end(key)
+            while len(self._layers) > self.cache_size:
+                self._layers.popitem(last=False)
+        return value
+
+    def get_box(self, image_size):
+        """Returns the bounding box the watermark covers on an image of the given size, or None."""
+        if self.tiled:
+            return None if self.get_layer(image_size[0]) is None else (0, 0) + tuple(image_size)
+        layer, (x, y) = self._get_placement(image_size)
+        if layer is None:
+            return None
+        return x, y, x + layer.width, y + layer.height
+
+    def apply(self, image: Image, in_place: bool = False) -> Image:
+        """Places the watermark on a copy of the image, or on the image itself with in_place set."""
+        if not in_place:
+            image = image.copy()
+        return self.apply_to_region(image, (0, 0), image.size)
+
+    def apply_derivatives(self, image: Image, max_sizes=DERIVATIVE_SIZES, reference_width: int = None):
+        """Yields each max size with a watermarked copy of the image fitted into it, largest first.
+
+        max_size None stands for the image at its own size. Every derivative is resampled from the next larger
+        unwatermarked one rather than from the full image, and the watermark is scaled by the derivative's width
+        relative to reference_width, the width the template was designed for, which defaults to the image
+        width. The image itself may be watermarked in place.
+        """
+        reference_width = reference_width or image.width
+        max_sizes = sorted(max_sizes, key=lambda max_size: float("inf") if max_size is None else max_size,
+                           reverse=True)
+        sizes = [image.size if max_size is None else fit_size(image.size, (max_size, max_size))
+                 for max_size in max_sizes]
+        current = image if image.size == sizes[0] else self._resize_derivative(image, sizes[0])
+        for index, max_size in enumerate(max_sizes):
+            following = self._resize_derivative(current, sizes[index + 1]) if index + 1 < len(sizes) else None
+            template = self.scaled(current.width / reference_width)
+            yield max_size, template.apply(current, in_place=True)
+            current = following
+
+    def _resize_derivative(self, image: Image, size) -> Image:
+        """Returns an unwatermarked copy of the image at the given size."""
+        with self.engine._stage("resize"):
+            return image.copy() if image.size == size else image.resize(size, Image.LANCZOS)
+
+    def scaled(self, scale: float):
+        """Returns the template for a copy of the image scaled by scale.
+
+        Font size, margins and tile spacing are scaled like the preview does; logos already follow the image
+        width. Scaled templates are cached alongside the layers and share the engine and the watermark image.
+        """
+        if scale >= 1:
+            return self
+        font_size = max(1, round(self.font_size * scale)) if self.font_size else self.font_size
+        margin_x = int(self.margin_x * scale)
+        margin_y = int(self.margin_y * scale)
+        spacing = int(self.spacing * scale) if self.spacing is not None else None
+        key = ("scaled", font_size, margin_x, margin_y, spacing)
+        return self._get_cached(key, lambda: WatermarkTemplate(
+            self.operation, self.position, margin_x, margin_y, text=self.text, font_size=font_size,
+            colour=self.colour, watermark_image=self.watermark_image, size=self.size, opacity=self.opacity,
+            tiled=self.tiled, angle=self.angle, spacing=spacing, engine=self.engine, cache_size=self.cache_size))
+
+    def apply_to_region(self, region: Image, region_xy, image_size) -> Image:
+        """Places the watermark on a region cut out of a larger image, in place.
+
+        region_xy is the top-left corner of the region within the full image of size image_size.
+        """
+        if self.tiled:
+            cell = self.get_tile_cell(image_size[0])
+            if cell is not None:
+                with self.engine._stage("composite"):
+                    composite_layer(region, tile_layer(cell, region_xy, region.size))
+            return region
+        layer, (x, y) = self._get_placement(image_size)
+        if layer is None:
+            return region
+        xy = (x - region_xy[0], y - region_xy[1])
+        with self.engine._stage("composite"):
+            composite_layer(region, layer, xy, opacity=self.opacity)
+        return region
+
+    def _get_placement(self, image_size):
+        """Returns the watermark layer for an image of the given size and the corner to place it at."""
+        layer = self.get_layer(image_size[0])
+        if layer is None:
+            return None, (0, 0)
+        if self.operation == "text":
+            with self.engine._stage("font_load"):
+                font = load_font(FONT_PATH, self.font_size)
+            layer_size = self.engine._get_text_dimensions(self.text, font)
         else:
-            new_width = 500
-            new_height = 500
-        new_size = (new_width, new_height)
-        controller.preview_width, controller.preview_height = new_size
-        preview_size_image = image.resize(new_size, Image.ANTIALIAS)
-        return preview_size_image
+            layer_size = layer.size
+        xy = self.engine._get_watermark_position(image_size, layer_size, self.position, self.margin_x, self.margin_y)
+        return layer, xy
+
+
+def watermark_region_file(source_path: str, output_path: str, template: WatermarkTemplate) -> bool:
+    """Writes a watermarked copy of an uncompressed image while decoding only the rows the watermark covers.
+
+    The file is copied through as is and the rows under the watermark are decoded, composited and written back
+    at their original offsets, REGION_BAND_ROWS rows at a time, so memory stays bounded regardless of the image
+    size, even for tiled watermarks that cover every row. Returns False without writing anything if the image is
+    not stored as uncompressed strips (e.g. PNG, JPEG or compressed TIFF); the caller should then fall back to a
+    full decode.
+    """
+    image = Image.open(source_path)
+    if image.mode not in REGION_MODES or getattr(image, "n_frames", 1) > 1:
+        return False
+    box = template.get_box(image.size)
+    if box is None:
+        rows = iter(())
+    else:
+        rows = _get_raw_rows(image, max(0, box[1]), min(image.height, box[3]))
+        if rows is None:
+            return False
+    image.close()
+    shutil.copyfile(source_path, output_path)
+    with open(output_path, "r+b") as file:
+        band_rows = []
+        for row in rows:
+            band_rows.append(row)
+            if len(band_rows) == REGION_BAND_ROWS:
+                _watermark_band(file, image, band_rows, template)
+                band_rows = []
+        if band_rows:
+            _watermark_band(file, image, band_rows, template)
+    return True
+
+
+def _watermark_band(file, image: Image, rows, template: WatermarkTemplate):
+    """Decodes consecutive raw rows from the open file, watermarks them and writes them back in place."""
+    top = rows[0][0]
+    band = Image.new(image.mode, (image.width, len(rows)))
+    for y, offset, row_size, rawmode in rows:
+        file.seek(offset)
+        row = Image.frombytes(image.mode, (image.width, 1), file.read(row_size), "raw", rawmode)
+        band.paste(row, (0, y - top))
+    template.apply_to_region(band, (0, top), image.size)
+    for y, offset, row_size, rawmode in rows:
+        file.seek(offset)
+        file.write(band.crop((0, y - top, image.width, y - top + 1)).tobytes("raw", rawmode))
+
+
+def _get_raw_rows(image: Image, top: int, bottom: int):
+    """Returns an iterator over (y, file offset, byte size, rawmode) for every row between top and bottom of an
+    uncompressed image, in order.
+
+    Returns None if the image data is not stored as full-width uncompressed strips holding every band of their
+    rows, e.g. for planar TIFFs, which store one plane per band.
+    """
+    if hasattr(image, "tag_v2") and image.tag_v2.get(284, 1) != 1:
+        return None
+    strips = []
+    for decoder_name, extents, offset, args in image.tile:
+        x0, y0, x1, y1 = extents
+        if decoder_name != "raw" or x0 != 0 or x1 != image.width:
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        try:
+            row_size = len(Image.new(image.mode, (image.width, 1)).tobytes("raw", rawmode))
+        except ValueError:
+            return None
+        strips.append((y0, y1, offset, row_size, stride or row_size, orientation, rawmode))
+    strips.sort()
+    if any(following[0] < previous[1] for previous, following in zip(strips, strips[1:])):
+        return None
+
+    def iterate_rows():
+        for y0, y1, offset, row_size, stride, orientation, rawmode in strips:
+            for y in range(max(y0, top), min(y1, bottom)):
+                if orientation < 0:
+                    row_offset = offset + (y1 - 1 - y) * stride
+                else:
+                    row_offset = offset + (y - y0) * stride
+                yield y, row_offset, row_size, rawmode
+
+    return iterate_rows()